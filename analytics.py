@@ -0,0 +1,126 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func
+from database import AsyncSession, UserAction, UserActionDaily, JobCursor, ContentAccessEvent
+import config
+
+# Raw user_actions rows are folded into per-day/per-user/per-action rows in
+# user_action_daily. The rollup walks user_actions by id past a stored cursor;
+# ids are increasing because all rows come from the single buffered writer in
+# utils.flush_pending_events. Raw rows are only pruned once they are rolled up.
+
+ROLLUP_CURSOR = 'user_action_rollup'
+
+async def _get_cursor(session, name):
+    """Load (or create) a job cursor row"""
+    cursor = await session.get(JobCursor, name)
+    if cursor is None:
+        cursor = JobCursor(name=name, position=0)
+        session.add(cursor)
+    return cursor
+
+async def rollup_user_actions():
+    """Fold new raw user actions into daily summary rows"""
+    total = 0
+    while True:
+        async with AsyncSession() as session:
+            cursor = await _get_cursor(session, ROLLUP_CURSOR)
+            rows = (await session.execute(
+                select(UserAction.id, UserAction.user_id, UserAction.action, UserAction.timestamp)
+                .filter(UserAction.id > cursor.position)
+                .order_by(UserAction.id)
+                .limit(config.ACTION_ROLLUP_BATCH_SIZE)
+            )).all()
+            if not rows:
+                break
+            
+            counts = Counter((row.timestamp.date(), row.user_id, row.action) for row in rows)
+            for (day, user_id, action), count in counts.items():
+                result = await session.execute(
+                    update(UserActionDaily)
+                    .filter_by(day=day, user_id=user_id, action=action)
+                    .values(count=UserActionDaily.count + count)
+                )
+                if result.rowcount == 0:
+                    session.add(UserActionDaily(day=day, user_id=user_id, action=action, count=count))
+            
+            # Cursor moves in the same transaction, so every row is counted exactly once
+            cursor.position = rows[-1].id
+            await session.commit()
+        
+        total += len(rows)
+        if len(rows) < config.ACTION_ROLLUP_BATCH_SIZE:
+            break
+        await asyncio.sleep(0)
+    
+    return total
+
+async def prune_user_actions():
+    """Delete rolled-up raw actions older than the retention window"""
+    cutoff = datetime.utcnow() - timedelta(days=config.ACTION_RETENTION_DAYS)
+    total = 0
+    while True:
+        async with AsyncSession() as session:
+            cursor = await _get_cursor(session, ROLLUP_CURSOR)
+            batch = (
+                select(UserAction.id)
+                .filter(UserAction.id <= cursor.position, UserAction.timestamp < cutoff)
+                .order_by(UserAction.id)
+                .limit(config.ACTION_PRUNE_BATCH_SIZE)
+            )
+            result = await session.execute(
+                delete(UserAction)
+                .filter(UserAction.id.in_(batch))
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        
+        total += result.rowcount
+        if result.rowcount < config.ACTION_PRUNE_BATCH_SIZE:
+            break
+        # Let other handlers run between batches
+        await asyncio.sleep(0)
+    
+    return total
+
+async def count_user_actions(session, user_id):
+    """Total actions for a user: rolled-up counts plus raw rows not rolled up yet"""
+    cursor = await session.get(JobCursor, ROLLUP_CURSOR)
+    position = cursor.position if cursor else 0
+    rolled_up = await session.scalar(
+        select(func.coalesce(func.sum(UserActionDaily.count), 0)).filter_by(user_id=user_id)
+    )
+    pending = await session.scalar(
+        select(func.count(UserAction.id))
+        .filter(UserAction.user_id == user_id, UserAction.id > position)
+    )
+    return rolled_up + pending
+
+async def get_daily_actions(session, user_id):
+    """Per-day action counts for a user, oldest first"""
+    return (await session.scalars(
+        select(UserActionDaily)
+        .filter_by(user_id=user_id)
+        .order_by(UserActionDaily.day, UserActionDaily.action)
+    )).all()
+
+async def get_top_contents(limit=10, subject_id=None, chapter_id=None, content_type=None, since=None):
+    """Most delivered content IDs with their delivery counts, most popular first"""
+    query = select(ContentAccessEvent.content_id, func.count(ContentAccessEvent.id).label('deliveries'))
+    
+    if subject_id:
+        query = query.filter(ContentAccessEvent.subject_id == subject_id)
+    if chapter_id:
+        query = query.filter(ContentAccessEvent.chapter_id == chapter_id)
+    if content_type:
+        query = query.filter(ContentAccessEvent.content_type == content_type)
+    if since:
+        query = query.filter(ContentAccessEvent.timestamp >= since)
+    
+    query = query.group_by(ContentAccessEvent.content_id) \
+        .order_by(func.count(ContentAccessEvent.id).desc()) \
+        .limit(limit)
+    
+    async with AsyncSession() as session:
+        return (await session.execute(query)).all()
@@ -0,0 +1,69 @@
+import os
+from collections import Counter
+from sqlalchemy import select, update, delete
+from database import AsyncSession, upsert, Blob, Content
+import config
+
+# Content files are stored once per distinct SHA-256, under
+# BLOBS_DIR/<ab>/<cd>/<sha256>.<ext>. Blob.ref_count is the number of Content
+# rows using a blob; it is kept in the same transaction as those rows, and the
+# file is unlinked (after commit) when the last reference goes.
+
+def blob_path(sha256, ext):
+    """Sharded storage path for a blob"""
+    return os.path.join(config.BLOBS_DIR, sha256[:2], sha256[2:4], f"{sha256}.{ext}")
+
+async def get_blob_path(sha256):
+    """Path of an already stored blob, or None"""
+    async with AsyncSession() as session:
+        return await session.scalar(select(Blob.file_path).filter_by(sha256=sha256))
+
+async def get_shared_file_id(session, sha256):
+    """A Telegram file_id already known for the same bytes, if any"""
+    return await session.scalar(
+        select(Content.file_id)
+        .filter(Content.file_sha256 == sha256, Content.file_id.isnot(None))
+        .limit(1)
+    )
+
+async def acquire_blob(session, sha256, file_path, size):
+    """Add a reference to a blob inside the caller's transaction"""
+    # One statement, so two uploads of the same new file can't both insert it
+    insert = upsert(Blob).values(sha256=sha256, file_path=file_path, size=size, ref_count=1)
+    await session.execute(insert.on_conflict_do_update(
+        index_elements=[Blob.sha256],
+        set_={'ref_count': Blob.ref_count + 1}
+    ))
+
+async def release_blobs(session, sha256s):
+    """Drop one reference per listed hash inside the caller's transaction
+    
+    Returns the paths of blobs left without references; the caller removes
+    them with remove_files() once the transaction has committed.
+    """
+    counts = Counter(sha256 for sha256 in sha256s if sha256)
+    if not counts:
+        return []
+    
+    for sha256, count in counts.items():
+        await session.execute(
+            update(Blob).filter_by(sha256=sha256).values(ref_count=Blob.ref_count - count)
+        )
+    orphaned = (await session.execute(
+        select(Blob.sha256, Blob.file_path).filter(Blob.sha256.in_(counts), Blob.ref_count <= 0)
+    )).all()
+    if orphaned:
+        await session.execute(
+            delete(Blob)
+            .filter(Blob.sha256.in_([row.sha256 for row in orphaned]))
+            .execution_options(synchronize_session=False)
+        )
+    return [row.file_path for row in orphaned]
+
+def remove_files(paths):
+    """Delete files, ignoring ones that are already gone"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,8 +1,18 @@
 import logging
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, TypeHandler,
+    ContextTypes, filters
+)
 import config
 from database import init_db
+from counters import ensure_counters
+from analytics import rollup_user_actions, prune_user_actions
+from persistence import DatabasePersistence
+from state import sweep_user_data, get_state_stats
+from warmup import warm_up_missing
+from mirror import mirror_missing
+from storage import evict_cold_files
 
 # Configure logging
 logging.basicConfig(
@@ -18,29 +28,119 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Log errors"""
     logger.error(f"Update {update} caused error {context.error}")
 
+async def flush_events_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically write buffered user actions and access events"""
+    await flush_pending_events()
+
+async def rollup_actions_job(context: ContextTypes.DEFAULT_TYPE):
+    """Roll raw user actions up into daily rows and prune old ones"""
+    rolled_up = await rollup_user_actions()
+    pruned = await prune_user_actions()
+    if rolled_up or pruned:
+        logger.info(f"Rolled up {rolled_up} user actions, pruned {pruned}")
+
+async def expire_blocks_job(context: ContextTypes.DEFAULT_TYPE):
+    """Unblock users whose temporary block has run out"""
+    expired = await expire_blocks()
+    if expired:
+        logger.info(f"Expired {expired} user blocks")
+
+async def sweep_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """Evict abandoned conversation state and report what is left"""
+    expired = sweep_user_data(context.application)
+    stats = get_state_stats(context.application)
+    logger.info(
+        f"Conversation state: expired {expired} flows, {stats['users_with_state']} users with state "
+        f"({stats['loaded_users']} loaded, ~{stats['state_bytes']} bytes), flows {stats['flows']}"
+    )
+
+async def warm_up_job(context: ContextTypes.DEFAULT_TYPE):
+    """Upload content that has no Telegram file_id yet to the storage chat"""
+    uploaded = await warm_up_missing(context.bot)
+    if uploaded:
+        logger.info(f"Warmed up {uploaded} content files")
+
+async def mirror_job(context: ContextTypes.DEFAULT_TYPE):
+    """Copy Telegram-ingested content that has no local copy yet to disk"""
+    mirrored = await mirror_missing(context.bot)
+    if mirrored:
+        logger.info(f"Mirrored {mirrored} content files to local storage")
+
+async def storage_job(context: ContextTypes.DEFAULT_TYPE):
+    """Evict local copies of cold content when the disk is running full"""
+    evicted, freed = await evict_cold_files()
+    if evicted:
+        logger.info(f"Evicted {evicted} cold content files ({format_file_size(freed)})")
+
+async def post_init(application: Application):
+    """Prepare caches and counters before polling starts"""
+    if await ensure_counters():
+        logger.info("Stats counters seeded from database")
+
+async def post_shutdown(application: Application):
+    """Write whatever is still buffered before the process exits"""
+    flushed = await flush_pending_events()
+    logger.info(f"Flushed {flushed} pending events on shutdown")
+
 def main():
     # Initialize database
     init_db()
     logger.info("Database initialized")
     
     # Create application
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    builder = Application.builder() \
+        .token(config.BOT_TOKEN) \
+        .persistence(DatabasePersistence()) \
+        .concurrent_updates(config.CONCURRENT_UPDATES) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown)
+    if config.BOT_API_URL:
+        builder = builder \
+            .base_url(f"{config.BOT_API_URL}/bot") \
+            .base_file_url(f"{config.BOT_API_URL}/file/bot") \
+            .local_mode(True)
+    application = builder.build()
     logger.info("Application created")
     
+    # Background jobs
+    application.job_queue.run_repeating(flush_events_job, interval=config.ACTION_LOG_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(rollup_actions_job, interval=config.ACTION_ROLLUP_INTERVAL, first=60)
+    application.job_queue.run_repeating(expire_blocks_job, interval=config.BLOCK_EXPIRY_INTERVAL, first=0)
+    application.job_queue.run_repeating(sweep_state_job, interval=config.STATE_SWEEP_INTERVAL)
+    if config.STORAGE_CHAT_ID:
+        application.job_queue.run_repeating(warm_up_job, interval=config.WARMUP_INTERVAL, first=30)
+    application.job_queue.run_repeating(storage_job, interval=config.STORAGE_CHECK_INTERVAL, first=60)
+    if config.MIRROR_FILES:
+        application.job_queue.run_repeating(mirror_job, interval=config.MIRROR_INTERVAL, first=120)
+    
     # Add error handler
     application.add_error_handler(error_handler)
     
+    # Expire abandoned flows before any handler sees the update
+    application.add_handler(TypeHandler(Update, track_user_state), group=-1)
+    
     # Add basic handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("reconcile_stats", reconcile_stats_command))
+    # Non-blocking: building and uploading a full export takes a while
+    application.add_handler(CommandHandler("export", export_command, block=False))
+    application.add_handler(CommandHandler("bulk", bulk_command))
     
     # Add callback query handler
     application.add_handler(CallbackQueryHandler(callback_query_handler))
     
+    # Add inline mode handler
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+    
     # Add message handlers
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.VIDEO | filters.Document.ALL, save_content_file_handler))
+    # Non-blocking: saving a large upload must not hold up other users' updates
+    application.add_handler(
+        MessageHandler(filters.VIDEO | filters.Document.ALL, save_content_file_handler, block=False)
+    )
     
     # Start bot
     logger.info("🤖 Board Booster Bot is starting...")
@@ -0,0 +1,77 @@
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from database import AsyncSession, Subject, Chapter, Content
+
+# In-memory copy of subjects -> chapters -> contents. It only changes when an
+# admin adds or deletes chapters/content, so it is loaded once and rebuilt
+# lazily after invalidate_catalog(). The version number lets other caches
+# (e.g. rendered keyboards) key on the catalog they were built from.
+_catalog = None
+_version = 0
+_load_lock = asyncio.Lock()
+
+async def _load_catalog():
+    """Read the whole catalog from the database"""
+    async with AsyncSession() as session:
+        subjects = (await session.scalars(select(Subject).order_by(Subject.id))).all()
+        chapters = (await session.scalars(
+            select(Chapter).options(selectinload(Chapter.subject)).order_by(Chapter.id)
+        )).all()
+        contents = (await session.scalars(select(Content).order_by(Content.id))).all()
+
+    catalog = {
+        'subjects_by_code': {subject.code: subject for subject in subjects},
+        'subjects_by_id': {subject.id: subject for subject in subjects},
+        'chapters_by_id': {chapter.id: chapter for chapter in chapters},
+        'chapters_by_subject': {subject.id: [] for subject in subjects},
+        'contents_by_id': {content.id: content for content in contents},
+        'contents': {},
+    }
+    for chapter in chapters:
+        catalog['chapters_by_subject'].setdefault(chapter.subject_id, []).append(chapter)
+    for content in contents:
+        key = (content.chapter_id, content.content_type, content.content_number)
+        catalog['contents'][key] = content
+
+    return catalog
+
+async def get_catalog():
+    """Return the cached catalog, loading it on first use"""
+    global _catalog
+    if _catalog is not None:
+        return _catalog
+
+    async with _load_lock:
+        if _catalog is not None:
+            return _catalog
+
+        version = _version
+        catalog = await _load_catalog()
+        # Don't keep a snapshot that was invalidated while loading
+        if version == _version:
+            _catalog = catalog
+        return catalog
+
+def get_catalog_version():
+    """Current catalog version; bumped on every invalidation"""
+    return _version
+
+def invalidate_catalog():
+    """Drop the cached catalog after chapters or contents change"""
+    global _catalog, _version
+    _catalog = None
+    _version += 1
+
+def set_content_file_id(content_id, file_id):
+    """Record a new Telegram file_id without reloading the catalog"""
+    update_catalog_content(content_id, file_id=file_id)
+
+def update_catalog_content(content_id, **values):
+    """Update file columns of a cached content without reloading the catalog"""
+    if _catalog is None:
+        return
+    content = _catalog['contents_by_id'].get(content_id)
+    if content is not None:
+        for field, value in values.items():
+            setattr(content, field, value)
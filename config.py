@@ -6,17 +6,39 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8570013024:AAEBDhWeV4dZJykQsb8IlcK4dK9g0VTUT04")
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "8064043725").split(',')))
 
+# How admin uploads are ingested: "local" downloads the file before
+# publishing; "telegram" publishes straight from the message's file_id and
+# copies the bytes to disk afterwards. Beyond DOWNLOAD_SIZE_LIMIT no copy can
+# be made, so "telegram" needs BOT_API_URL to keep a copy of larger lectures
+INGEST_MODE = os.getenv("INGEST_MODE", "local")
+# Keep local copies of Telegram-ingested files (fallback if a file_id is rejected)
+MIRROR_FILES = os.getenv("MIRROR_FILES", "1") != "0"
+
+# Local Bot API server (e.g. http://localhost:8081), which lifts the cloud
+# Bot API's 20 MB limit on files bots can download
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/") or None
+# Largest file the bot can download from Telegram; None means no limit
+DOWNLOAD_SIZE_LIMIT = None if BOT_API_URL else 20 * 1024 * 1024
+
+# Private chat/channel the bot uploads content to once, to get reusable file_ids
+STORAGE_CHAT_ID = int(os.getenv("STORAGE_CHAT_ID", "0")) or None
+
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot_data.db")
 
+# Updates handled at the same time; updates beyond this wait for a free slot
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
 # File storage paths
 FILES_DIR = "storage"
 LECTURES_DIR = os.path.join(FILES_DIR, "lectures")
 NOTES_DIR = os.path.join(FILES_DIR, "notes")
 DPP_DIR = os.path.join(FILES_DIR, "dpp")
+EXPORTS_DIR = os.path.join(FILES_DIR, "exports")
+BLOBS_DIR = os.path.join(FILES_DIR, "blobs")  # content-addressed content files
 
 # Create directories if they don't exist
-for directory in [FILES_DIR, LECTURES_DIR, NOTES_DIR, DPP_DIR]:
+for directory in [FILES_DIR, LECTURES_DIR, NOTES_DIR, DPP_DIR, EXPORTS_DIR, BLOBS_DIR]:
     os.makedirs(directory, exist_ok=True)
 
 # Subjects with symbols
@@ -36,3 +58,61 @@ CONTENT_TYPES = {
 
 MAX_WARNINGS = 5
 BLOCK_DURATION = 24 * 60 * 60  # 24 hours in seconds
+BLOCK_EXPIRY_INTERVAL = 60  # seconds between runs of the block expiry job
+LAST_ACTIVE_UPDATE_INTERVAL = 5 * 60  # persist last_active at most once per 5 minutes
+
+# In-process user/moderation state cache
+USER_CACHE_SIZE = 20000  # LRU-evicted beyond this many users
+USER_CACHE_TTL = 10 * 60  # seconds before a cached user is re-read
+
+STATS_CACHE_TTL = 60  # seconds admin dashboard stats are reused
+
+USERS_PAGE_SIZE = 20  # users per page in the admin user browser
+BULK_MODERATION_BATCH_SIZE = 5000  # users updated per transaction by bulk actions
+BULK_PROGRESS_INTERVAL = 3  # seconds between progress message edits
+
+SEARCH_RESULTS_LIMIT = 10  # results shown by /search
+
+# Inline mode (@bot physics kinematics note 2)
+INLINE_RESULTS_LIMIT = 20  # results per inline answer (Telegram allows 50)
+INLINE_CACHE_TIME = 5 * 60  # seconds results are cached, by us and by Telegram
+INLINE_CACHE_SIZE = 1000  # distinct queries kept in memory
+
+# Buffered user action logging
+ACTION_LOG_BATCH_SIZE = 500  # flush as soon as this many actions are queued
+ACTION_LOG_FLUSH_INTERVAL = 10  # seconds between background flushes
+
+# user_actions rollups and retention
+ACTION_ROLLUP_INTERVAL = 15 * 60  # seconds between rollup/prune runs
+ACTION_ROLLUP_BATCH_SIZE = 5000  # raw rows folded per transaction
+ACTION_RETENTION_DAYS = 90  # raw rows older than this are deleted once rolled up
+ACTION_PRUNE_BATCH_SIZE = 5000  # raw rows deleted per transaction
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes read per chunk when saving admin uploads
+DOWNLOAD_TIMEOUT = 60  # seconds without progress before a download is abandoned
+UPLOAD_TIMEOUT = 5 * 60  # seconds allowed for uploading one content file
+WARMUP_INTERVAL = 15 * 60  # seconds between sweeps for content without a file_id
+WARMUP_BATCH_SIZE = 20  # uploads per sweep
+WARMUP_DELAY = 2  # seconds between uploads, to stay under Telegram rate limits
+
+STORAGE_MIN_FREE_MB = 1024  # evict local copies when free disk space drops below this
+STORAGE_TARGET_FREE_MB = 2048  # ...until this much is free; evicted files come back only above it
+STORAGE_CHECK_INTERVAL = 10 * 60  # seconds between disk space checks
+ORPHAN_FILE_MIN_AGE = 60 * 60  # seconds an unreferenced blob or partial download is left alone
+
+MIRROR_INTERVAL = 30 * 60  # seconds between sweeps for content without a local copy
+MIRROR_BATCH_SIZE = 20  # downloads per sweep
+
+STATE_FLUSH_INTERVAL = 30  # seconds between writes of changed conversation state
+STATE_SWEEP_INTERVAL = 5 * 60  # seconds between sweeps for abandoned conversation state
+
+# Seconds a multi-step flow may sit idle before its state is dropped
+FLOW_STATE_TTL = {
+    "browse": 10 * 60,
+    "admin_chapters": 30 * 60,
+    "admin_add_content": 60 * 60,
+    "user_search": 30 * 60
+}
+
+EXPORT_BATCH_SIZE = 1000  # rows fetched per round trip when exporting
+EXPORT_MAX_SIZE = 50 * 1024 * 1024  # bytes; the Bot API rejects larger documents
@@ -0,0 +1,93 @@
+from datetime import datetime
+from sqlalchemy import select, delete, func
+from database import AsyncSession, upsert, StatCounter, User, Chapter, Content
+
+# Dashboard numbers are kept in the stat_counters table and adjusted in the
+# same transaction as the write that changes them, so reading them is O(1).
+# reconcile_counters() rebuilds the table from the real rows if they drift.
+
+def subject_chapters(subject_id):
+    return f"subject_chapters:{subject_id}"
+
+def subject_contents(subject_id):
+    return f"subject_contents:{subject_id}"
+
+def type_contents(content_type):
+    return f"type_contents:{content_type}"
+
+def active_day(day):
+    return f"active_day:{day.isoformat()}"
+
+def today_start():
+    """Start of the current UTC day"""
+    return datetime.combine(datetime.utcnow().date(), datetime.min.time())
+
+async def bump_counters(session, deltas):
+    """Apply counter deltas inside the caller's transaction"""
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        # One statement, so concurrent first bumps of a counter can't both insert it
+        insert = upsert(StatCounter).values(name=name, value=delta)
+        await session.execute(insert.on_conflict_do_update(
+            index_elements=[StatCounter.name],
+            set_={'value': StatCounter.value + insert.excluded.value}
+        ))
+
+def content_deltas(subject_id, contents, sign=1):
+    """Counter deltas for adding (sign=1) or removing (sign=-1) contents"""
+    deltas = {}
+    for content in contents:
+        for name in ('contents', subject_contents(subject_id), type_contents(content.content_type)):
+            deltas[name] = deltas.get(name, 0) + sign
+    return deltas
+
+async def get_counters():
+    """Return all counters as a dict"""
+    async with AsyncSession() as session:
+        return dict((await session.execute(select(StatCounter.name, StatCounter.value))).all())
+
+async def reconcile_counters():
+    """Recompute every counter from the underlying tables"""
+    async with AsyncSession() as session:
+        user_count = await session.scalar(select(func.count(User.id)))
+        blocked_count = await session.scalar(select(func.count(User.id)).filter_by(is_blocked=True))
+        today_count = await session.scalar(
+            select(func.count(User.id)).filter(User.last_active >= today_start())
+        )
+        chapters_by_subject = (await session.execute(
+            select(Chapter.subject_id, func.count(Chapter.id)).group_by(Chapter.subject_id)
+        )).all()
+        contents_by_subject = (await session.execute(
+            select(Chapter.subject_id, func.count(Content.id))
+            .join(Content, Content.chapter_id == Chapter.id)
+            .group_by(Chapter.subject_id)
+        )).all()
+        contents_by_type = (await session.execute(
+            select(Content.content_type, func.count(Content.id)).group_by(Content.content_type)
+        )).all()
+        
+        counters = {
+            'users': user_count,
+            'blocked_users': blocked_count,
+            active_day(datetime.utcnow().date()): today_count,
+            'chapters': sum(count for _, count in chapters_by_subject),
+            'contents': sum(count for _, count in contents_by_subject),
+        }
+        counters.update((subject_chapters(subject_id), count) for subject_id, count in chapters_by_subject)
+        counters.update((subject_contents(subject_id), count) for subject_id, count in contents_by_subject)
+        counters.update((type_contents(content_type), count) for content_type, count in contents_by_type)
+        
+        await session.execute(delete(StatCounter))
+        session.add_all(StatCounter(name=name, value=value) for name, value in counters.items())
+        await session.commit()
+    
+    return counters
+
+async def ensure_counters():
+    """Seed the counters table on first start"""
+    async with AsyncSession() as session:
+        if await session.scalar(select(func.count()).select_from(StatCounter)):
+            return False
+    await reconcile_counters()
+    return True
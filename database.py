@@ -1,13 +1,43 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text, ForeignKey
+import logging
+from sqlalchemy import (
+    create_engine, inspect, Column, Integer, BigInteger, String, Boolean, Date, DateTime, Text, ForeignKey, Index,
+    select, func, text
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime
 import config
 
+logger = logging.getLogger(__name__)
+
+def get_async_database_url(url):
+    """Map a sync database URL onto its asyncio driver"""
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
 Base = declarative_base()
+
+# Sync engine is only used at startup (init_db); handlers go through AsyncSession
 engine = create_engine(config.DATABASE_URL)
 Session = sessionmaker(bind=engine)
 
+async_engine = create_async_engine(get_async_database_url(config.DATABASE_URL))
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+def upsert(model):
+    """INSERT for the configured dialect, supporting on_conflict_do_update()"""
+    if async_engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -21,6 +51,17 @@ class User(Base):
     blocked_until = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_active = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_users_last_active', 'last_active'),
+        # Block expiry job: range scan over due blocks
+        Index('ix_users_blocked_until', 'blocked_until'),
+        # Keyset pagination of the admin user browser (newest first, optionally blocked only)
+        Index('ix_users_is_blocked_id', 'is_blocked', 'id'),
+        # Case-insensitive prefix search by username / first name
+        Index('ix_users_username_lower', func.lower(username)),
+        Index('ix_users_first_name_lower', func.lower(first_name)),
+    )
 
 class Subject(Base):
     __tablename__ = 'subjects'
@@ -40,6 +81,10 @@ class Chapter(Base):
     
     subject = relationship("Subject", backref="chapters")
     contents = relationship("Content", back_populates="chapter", cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        Index('ix_chapters_subject_id', 'subject_id'),
+    )
 
 class Content(Base):
     __tablename__ = 'contents'
@@ -48,11 +93,32 @@ class Content(Base):
     chapter_id = Column(Integer, ForeignKey('chapters.id'), nullable=False)
     content_type = Column(String(20), nullable=False)  # lecture, note, dpp
     content_number = Column(Integer, nullable=False)
-    file_path = Column(String(500), nullable=False)
+    file_path = Column(String(500), nullable=False)  # empty until there is a local copy
     file_id = Column(String(200))  # Telegram file_id for faster sending
+    file_unique_id = Column(String(100))  # Telegram's stable ID for the same file
+    file_size = Column(BigInteger)  # bytes
+    file_sha256 = Column(String(64))  # hex digest of the stored file
     created_at = Column(DateTime, default=datetime.utcnow)
     
     chapter = relationship("Chapter", back_populates="contents", overlaps="contents")
+    
+    __table_args__ = (
+        # Unique index rather than a constraint so it can be added to existing SQLite tables
+        Index('uq_contents_chapter_type_number', 'chapter_id', 'content_type', 'content_number', unique=True),
+        # Contents sharing a blob (and so a Telegram file_id)
+        Index('ix_contents_file_sha256', 'file_sha256'),
+        Index('ix_contents_file_unique_id', 'file_unique_id'),
+    )
+
+class Blob(Base):
+    """A stored content file, shared by all contents with the same SHA-256"""
+    __tablename__ = 'blobs'
+    
+    sha256 = Column(String(64), primary_key=True)
+    file_path = Column(String(500), nullable=False)
+    size = Column(BigInteger)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 class UserAction(Base):
     __tablename__ = 'user_actions'
@@ -61,9 +127,208 @@ class UserAction(Base):
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     action = Column(String(50), nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_user_actions_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+class ContentAccessEvent(Base):
+    __tablename__ = 'content_access_events'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    # No foreign keys: access history outlives deleted content
+    content_id = Column(Integer, nullable=False)
+    chapter_id = Column(Integer, nullable=False)
+    subject_id = Column(Integer, nullable=False)
+    content_type = Column(String(20), nullable=False)
+    delivery = Column(String(20), nullable=False)  # file_id (cached send) or upload
+    latency_ms = Column(Integer)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_content_access_events_content_id_timestamp', 'content_id', 'timestamp'),
+        Index('ix_content_access_events_subject_type_content', 'subject_id', 'content_type', 'content_id'),
+        Index('ix_content_access_events_chapter_content', 'chapter_id', 'content_id'),
+    )
+
+class UserActionDaily(Base):
+    __tablename__ = 'user_action_daily'
+    
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    action = Column(String(50), nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('uq_user_action_daily_day_user_action', 'day', 'user_id', 'action', unique=True),
+        Index('ix_user_action_daily_user_id_day', 'user_id', 'day'),
+    )
+
+class JobCursor(Base):
+    __tablename__ = 'job_cursors'
+    
+    name = Column(String(50), primary_key=True)
+    position = Column(Integer, nullable=False, default=0)
+
+class SearchDocument(Base):
+    __tablename__ = 'search_documents'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)  # chapter or content
+    ref_id = Column(Integer, nullable=False)
+    title = Column(String(300), nullable=False)
+    body = Column(Text, nullable=False, default='')
+    
+    __table_args__ = (
+        Index('uq_search_documents_kind_ref_id', 'kind', 'ref_id', unique=True),
+    )
+
+class UserState(Base):
+    """Per-user conversation state (context.user_data) as JSON"""
+    __tablename__ = 'user_states'
+    
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    data = Column(Text, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class StatCounter(Base):
+    __tablename__ = 'stat_counters'
+    
+    name = Column(String(100), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+def _create_indexes(connection, *names):
+    """Create the named model indexes if they don't exist yet"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+def _add_columns(connection, table_name, *names):
+    """Add the named model columns to an existing table if they are missing"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    table = Base.metadata.tables[table_name]
+    for name in names:
+        if name not in existing:
+            column_type = table.c[name].type.compile(connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+
+def _check_content_duplicates(connection):
+    """Refuse to build uq_contents_chapter_type_number over duplicate rows"""
+    duplicates = connection.execute(text(
+        "SELECT chapter_id, content_type, content_number, COUNT(*) FROM contents "
+        "GROUP BY chapter_id, content_type, content_number HAVING COUNT(*) > 1"
+    )).all()
+    if duplicates:
+        listing = ", ".join(
+            f"chapter {chapter_id} {content_type} #{number} ({count} rows)"
+            for chapter_id, content_type, number, count in duplicates
+        )
+        raise RuntimeError(
+            f"Duplicate contents must be removed before the unique index can be created: {listing}"
+        )
+
+def _migration_1(connection):
+    """Indexes on the hot lookup paths"""
+    _check_content_duplicates(connection)
+    _create_indexes(
+        connection,
+        'ix_users_last_active',
+        'ix_users_is_blocked',
+        'ix_chapters_subject_id',
+        'uq_contents_chapter_type_number',
+        'ix_user_actions_user_id_timestamp',
+    )
+
+def _migration_2(connection):
+    """Admin user browser: paging and search indexes"""
+    connection.execute(text("DROP INDEX IF EXISTS ix_users_is_blocked"))
+    _create_indexes(
+        connection,
+        'ix_users_is_blocked_id',
+        'ix_users_username_lower',
+        'ix_users_first_name_lower',
+    )
+
+def _migration_3(connection):
+    """Full-text search index over chapters and contents"""
+    from search import create_search_index
+    create_search_index(connection)
+
+def _migration_4(connection):
+    """Scheduled block expiry: index on blocked_until"""
+    _create_indexes(connection, 'ix_users_blocked_until')
+
+def _migration_5(connection):
+    """Size and checksum of stored content files"""
+    _add_columns(connection, 'contents', 'file_size', 'file_sha256')
+
+def _migration_6(connection):
+    """Content-addressed storage: register already hashed files as blobs"""
+    _create_indexes(connection, 'ix_contents_file_sha256')
+    connection.execute(text(
+        "INSERT INTO blobs (sha256, file_path, size, ref_count, created_at) "
+        "SELECT file_sha256, MIN(file_path), MAX(file_size), COUNT(*), MIN(created_at) FROM contents "
+        "WHERE file_sha256 IS NOT NULL "
+        "AND file_sha256 NOT IN (SELECT sha256 FROM blobs) "
+        "GROUP BY file_sha256"
+    ))
+
+def _migration_7(connection):
+    """Telegram-native ingest: file_unique_id"""
+    _add_columns(connection, 'contents', 'file_unique_id')
+    _create_indexes(connection, 'ix_contents_file_unique_id')
+
+# Applied in order to databases created before the change; append only.
+# create_all() already builds new databases with the current schema, and every
+# migration must be safe to run on such a database too.
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+]
+
+def migrate_db():
+    """Bring an existing database up to the latest schema version"""
+    with engine.begin() as connection:
+        version = connection.scalar(select(SchemaVersion.version).filter_by(id=1))
+        if version is None:
+            connection.execute(SchemaVersion.__table__.insert().values(id=1, version=0))
+            version = 0
+    
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        try:
+            with engine.begin() as connection:
+                migration(connection)
+                connection.execute(
+                    SchemaVersion.__table__.update().filter_by(id=1).values(version=number)
+                )
+        except Exception as e:
+            # The version stays where it is; don't run the bot on a half-migrated schema
+            logger.error(f"Schema migration {number} failed: {e}")
+            raise
+        logger.info(f"Applied schema migration {number}")
+        version = number
+    
+    return version
 
 def init_db():
     Base.metadata.create_all(engine)
+    migrate_db()
     
     # Add default subjects if they don't exist
     session = Session()
@@ -0,0 +1,111 @@
+import os
+import json
+import zlib
+import aiofiles
+from database import AsyncSession, User, UserAction, UserActionDaily
+from sqlalchemy import select
+from utils import flush_pending_events
+import config
+
+# Streams user data as NDJSON, one record per line with a "type" field
+# (user, action, daily_action). Rows are fetched in EXPORT_BATCH_SIZE
+# partitions through a server-side cursor and written as they arrive, so
+# memory stays flat however long a user's history is.
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+def _user_record(row):
+    return {
+        'type': 'user',
+        'user_id': row.user_id,
+        'username': row.username,
+        'first_name': row.first_name,
+        'last_name': row.last_name,
+        'is_blocked': row.is_blocked,
+        'warnings': row.warnings,
+        'blocked_until': _isoformat(row.blocked_until),
+        'created_at': _isoformat(row.created_at),
+        'last_active': _isoformat(row.last_active)
+    }
+
+def _action_record(row):
+    return {
+        'type': 'action',
+        'user_id': row.user_id,
+        'action': row.action,
+        'timestamp': _isoformat(row.timestamp)
+    }
+
+def _daily_action_record(row):
+    return {
+        'type': 'daily_action',
+        'user_id': row.user_id,
+        'day': _isoformat(row.day),
+        'action': row.action,
+        'count': row.count
+    }
+
+def _export_queries(user_id=None):
+    """(query, record builder) pairs, in output order"""
+    queries = [
+        (
+            select(
+                User.user_id, User.username, User.first_name, User.last_name, User.is_blocked,
+                User.warnings, User.blocked_until, User.created_at, User.last_active
+            ).order_by(User.user_id),
+            _user_record
+        ),
+        (
+            select(UserAction.user_id, UserAction.action, UserAction.timestamp)
+            .order_by(UserAction.user_id, UserAction.timestamp),
+            _action_record
+        ),
+        (
+            select(UserActionDaily.user_id, UserActionDaily.day, UserActionDaily.action, UserActionDaily.count)
+            .order_by(UserActionDaily.user_id, UserActionDaily.day),
+            _daily_action_record
+        ),
+    ]
+    if user_id is not None:
+        queries = [
+            (query.filter(query.selected_columns.user_id == user_id), to_record)
+            for query, to_record in queries
+        ]
+    return queries
+
+async def export_ndjson(file_path, user_id=None, compress=False):
+    """Export one user (or everyone) to an NDJSON file; returns the record count"""
+    await flush_pending_events()
+    
+    # wbits=31 makes zlib emit a gzip container
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    temp_path = f"{file_path}.part"
+    count = 0
+    
+    try:
+        async with aiofiles.open(temp_path, 'wb') as file:
+            async with AsyncSession() as session:
+                for query, to_record in _export_queries(user_id):
+                    result = await session.stream(
+                        query.execution_options(yield_per=config.EXPORT_BATCH_SIZE)
+                    )
+                    async for rows in result.partitions():
+                        data = ''.join(
+                            json.dumps(to_record(row), ensure_ascii=False) + '\n' for row in rows
+                        ).encode('utf-8')
+                        if compressor:
+                            data = compressor.compress(data)
+                        await file.write(data)
+                        count += len(rows)
+            
+            if compressor:
+                await file.write(compressor.flush())
+        
+        os.replace(temp_path, file_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    
+    return count
@@ -1,17 +1,37 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup,
+    InlineQueryResultCachedDocument, InlineQueryResultCachedVideo
+)
 from telegram.ext import ContextTypes
-from telegram.error import BadRequest
+from telegram.error import BadRequest, TelegramError
+import logging
 import os
+import time
 from datetime import datetime
 
 import config
-from database import Session, Subject, Chapter, Content
 from keyboards import *
 from utils import *
+from counters import reconcile_counters
+from export import export_ndjson
+from analytics import get_top_contents
+from cache import TTLCache
+from catalog import get_catalog_version
+from state import set_flow_state, end_flow, expire_flows, touch_user
+from warmup import warm_up_content, upload_content, upload_once
+from mirror import mirror_content
+from storage import has_room_for_rehydration
+
+logger = logging.getLogger(__name__)
+
+# Inline answers by (catalog version, normalized query)
+_inline_results_cache = TTLCache(maxsize=config.INLINE_CACHE_SIZE, ttl=config.INLINE_CACHE_TIME)
+# Content admins were already told can't be delivered; reported once per run
+_reported_undeliverable = set()
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db_user = get_user(user.id, user.username, user.first_name, user.last_name)
+    db_user = await get_user(user.id, user.username, user.first_name, user.last_name)
     
     if db_user.is_blocked and user.id not in config.ADMIN_IDS:
         await update.message.reply_text("🚫 You are currently blocked. Please try again later.")
@@ -36,7 +56,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown',
         reply_markup=get_main_menu_keyboard(is_admin=user.id in config.ADMIN_IDS)
     )
-    log_user_action(user.id, "start")
+    await log_user_action(user.id, "start")
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -51,6 +71,217 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_admin_keyboard()
     )
 
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Search chapters and contents: /search <terms>"""
+    user = update.effective_user
+    db_user = await get_user(user.id, user.username, user.first_name, user.last_name)
+    
+    if db_user.is_blocked and user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("🚫 You are currently blocked. Please try again later.")
+        return
+    
+    search_term = " ".join(context.args).strip()
+    if not search_term:
+        await update.message.reply_text("🔍 Usage: /search <chapter or topic>\nExample: /search kinematics note 2")
+        return
+    
+    results = await search_catalog(search_term)
+    if not results:
+        await update.message.reply_text(f"❌ No results for '{search_term}'.")
+        return
+    
+    await update.message.reply_text(
+        f"🔍 Results for '{search_term}':",
+        reply_markup=get_search_results_keyboard(results)
+    )
+    await log_user_action(user.id, "search")
+
+def build_inline_result(content, chapter):
+    """Cached-file inline result for content that already has a Telegram file_id"""
+    title = f"{config.CONTENT_TYPES[content.content_type]} #{content.content_number} · {chapter.name}"
+    description = chapter.subject.name
+    if content.content_type == "lecture":
+        return InlineQueryResultCachedVideo(
+            id=str(content.id),
+            video_file_id=content.file_id,
+            title=title,
+            description=description,
+            caption=get_content_caption(content)
+        )
+    return InlineQueryResultCachedDocument(
+        id=str(content.id),
+        document_file_id=content.file_id,
+        title=title,
+        description=description,
+        caption=get_content_caption(content)
+    )
+
+async def get_inline_results(search_term):
+    """Inline results for a query; an empty query lists the most downloaded content"""
+    key = (get_catalog_version(), search_term)
+    results = _inline_results_cache.get(key)
+    if results is not None:
+        return results
+    
+    matches = []
+    if search_term:
+        for kind, item, chapter in await search_catalog(search_term, config.INLINE_RESULTS_LIMIT * 2):
+            if kind == "content":
+                matches.append((item, chapter))
+    else:
+        for content_id, _ in await get_top_contents(limit=config.INLINE_RESULTS_LIMIT * 2):
+            content = await get_content_by_id(content_id)
+            if content:
+                matches.append((content, await get_chapter_by_id(content.chapter_id)))
+    
+    # Only content already uploaded to Telegram can be sent as a cached file
+    results = [
+        build_inline_result(content, chapter)
+        for content, chapter in matches
+        if content.file_id and chapter
+    ][:config.INLINE_RESULTS_LIMIT]
+    _inline_results_cache.set(key, results)
+    return results
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer @bot queries with cached lecture/note/DPP files"""
+    inline_query = update.inline_query
+    user = inline_query.from_user
+    db_user = await get_user(user.id, user.username, user.first_name, user.last_name)
+    
+    if db_user.is_blocked and user.id not in config.ADMIN_IDS:
+        await inline_query.answer([], cache_time=config.INLINE_CACHE_TIME, is_personal=True)
+        return
+    
+    search_term = " ".join(inline_query.query.lower().split())
+    results = await get_inline_results(search_term)
+    # Personal, so Telegram never serves these cached results to a blocked user
+    await inline_query.answer(results, cache_time=config.INLINE_CACHE_TIME, is_personal=True)
+
+async def reconcile_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Rebuild dashboard counters from the database (admin only)"""
+    user = update.effective_user
+    
+    if user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("⛔ You are not authorized to perform this action.")
+        return
+    
+    counters = await reconcile_counters()
+    await update.message.reply_text(
+        f"✅ Stats counters rebuilt.\n"
+        f"Users: {counters['users']} ({counters['blocked_users']} blocked)\n"
+        f"Chapters: {counters['chapters']}\n"
+        f"Contents: {counters['contents']}"
+    )
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send user data as gzipped NDJSON: /export [user_id] (admin only)"""
+    user = update.effective_user
+    
+    if user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("⛔ You are not authorized to perform this action.")
+        return
+    
+    try:
+        user_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("Usage: /export [user_id]")
+        return
+    
+    filename = f"export_{user_id or 'all'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz"
+    file_path = os.path.join(config.EXPORTS_DIR, filename)
+    
+    await update.message.reply_text("⏳ Preparing export...")
+    count = await export_ndjson(file_path, user_id, compress=True)
+    
+    try:
+        if count == 0:
+            await update.message.reply_text("❌ Nothing to export.")
+            return
+        file_size = os.path.getsize(file_path)
+        if file_size > config.EXPORT_MAX_SIZE:
+            await update.message.reply_text(
+                f"❌ Export is {format_file_size(file_size)}, over Telegram's "
+                f"{format_file_size(config.EXPORT_MAX_SIZE)} limit. Export a single user instead."
+            )
+            return
+        with open(file_path, 'rb') as file:
+            await update.message.reply_document(
+                document=file,
+                filename=filename,
+                caption=f"📦 {count} records"
+            )
+    finally:
+        os.remove(file_path)
+
+# Filters used by the admin panel's bulk action buttons
+BULK_PRESETS = {
+    'clear': {},
+    'block': {'min_warnings': config.MAX_WARNINGS - 1},
+    'unblock': {},
+}
+
+def describe_bulk_action(action, inactive_days=None, min_warnings=None):
+    """Human-readable summary of a bulk action and its filters"""
+    description = BULK_ACTIONS[action]
+    if action == 'clear':
+        description += " for"
+    description += " all users"
+    if inactive_days is not None:
+        description += f" inactive for {inactive_days}+ days"
+    if min_warnings is not None:
+        description += f" with {min_warnings}+ warnings"
+    return description
+
+async def run_bulk_action(message, action, inactive_days=None, min_warnings=None):
+    """Run a bulk moderation action, reporting progress by editing message"""
+    description = describe_bulk_action(action, inactive_days, min_warnings)
+    last_report = time.monotonic()
+    
+    async def progress(total):
+        nonlocal last_report
+        if time.monotonic() - last_report >= config.BULK_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await message.edit_text(f"⏳ {description}: {total} users updated so far...")
+    
+    total = await bulk_moderate(action, inactive_days, min_warnings, progress)
+    await message.edit_text(f"✅ {description}: {total} users updated.")
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Bulk moderation: /bulk clear|block|unblock [inactive=<days>] [warnings=<n>] (admin only)"""
+    user = update.effective_user
+    
+    if user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("⛔ You are not authorized to perform this action.")
+        return
+    
+    usage = (
+        "Usage: /bulk clear|block|unblock [inactive=<days>] [warnings=<n>]\n"
+        "Example: /bulk unblock inactive=30"
+    )
+    if not context.args or context.args[0] not in BULK_ACTIONS:
+        await update.message.reply_text(usage)
+        return
+    
+    filters = {}
+    for arg in context.args[1:]:
+        key, _, value = arg.partition("=")
+        if key not in ("inactive", "warnings") or not value.isdigit():
+            await update.message.reply_text(usage)
+            return
+        filters['inactive_days' if key == "inactive" else 'min_warnings'] = int(value)
+    
+    message = await update.message.reply_text("⏳ Starting bulk action...")
+    # Large batches take a while; run them without holding up the handler
+    context.application.create_task(run_bulk_action(message, context.args[0], **filters), update=update)
+
+async def track_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop the user's abandoned flows before the update is routed"""
+    if update.effective_user is None:
+        return
+    touch_user(update.effective_user.id)
+    expire_flows(context.user_data)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
@@ -72,6 +303,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Check if we're waiting for chapter name
             if context.user_data.get('awaiting_chapter_name'):
                 await handle_chapter_name_input(update, context)
+            elif context.user_data.get('awaiting_user_search'):
+                context.user_data.pop('awaiting_user_search', None)
+                set_flow_state(context.user_data, 'user_search', user_search=text)
+                await show_users_page(update.message.reply_text, context, "search")
             elif context.user_data.get('awaiting_content_number'):
                 await enter_content_number_admin_handler(update, context)
             else:
@@ -81,7 +316,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Regular users
-    db_user = get_user(user.id, user.username, user.first_name, user.last_name)
+    db_user = await get_user(user.id, user.username, user.first_name, user.last_name)
     
     if db_user.is_blocked:
         await update.message.reply_text("🚫 You are currently blocked. Please try again later.")
@@ -103,7 +338,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await send_content_number(update, context)
         else:
             # Unauthorized message for regular users only
-            warnings = add_warning(user.id)
+            warnings = await add_warning(user.id)
             remaining = config.MAX_WARNINGS - warnings
             
             if remaining > 0:
@@ -129,6 +364,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     4. Select content type (Lecture/Note/DPP)
     5. Enter content number
     
+    Or search directly: `/search kinematics note 2`
+    
     *Content Types:*
     • 🎥 *Lecture*: Video explanations
     • 📝 *Note*: Detailed PDF notes
@@ -157,31 +394,39 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     # Browse Subjects Flow
     if data.startswith("subject_"):
         subject_code = data.split("_")[1]
-        session = Session()
-        subject = session.query(Subject).filter_by(code=subject_code).first()
+        subject = await get_subject_by_code(subject_code)
         
         if subject:
-            context.user_data['current_subject'] = subject.id
             await query.edit_message_text(
                 f"📖 *{subject.name}*\nSelect a chapter:",
                 parse_mode='Markdown',
-                reply_markup=get_chapters_keyboard(subject.id, "browse")
+                reply_markup=await get_chapters_keyboard(subject.id, "browse")
             )
-        session.close()
     
     elif data.startswith("chapter_browse_"):
         chapter_id = int(data.split("_")[2])
-        session = Session()
-        chapter = session.query(Chapter).get(chapter_id)
+        chapter = await get_chapter_by_id(chapter_id)
         
         if chapter:
-            context.user_data['current_chapter'] = chapter_id
             await query.edit_message_text(
                 f"📚 *{chapter.name}*\nSelect content type:",
                 parse_mode='Markdown',
                 reply_markup=get_content_types_keyboard(chapter_id, "browse")
             )
-        session.close()
+    
+    elif data.startswith("content_get_"):
+        content_id = int(data.split("_")[2])
+        db_user = await get_user(user.id, user.username, user.first_name, user.last_name)
+        
+        if db_user.is_blocked and user.id not in config.ADMIN_IDS:
+            await query.edit_message_text("🚫 You are currently blocked. Please try again later.")
+            return
+        
+        content = await get_content_by_id(content_id)
+        if not content:
+            await query.edit_message_text("❌ This content is no longer available.")
+        elif not await deliver_content(context, query.message.chat_id, user.id, content):
+            await query.edit_message_text("❌ File not found. Please contact admin.")
     
     elif data.startswith("content_browse_"):
         _, _, chapter_id, content_type = data.split("_")
@@ -190,46 +435,41 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text(
             f"Enter content number for {config.CONTENT_TYPES[content_type]}:"
         )
-        context.user_data['browse_chapter'] = chapter_id
-        context.user_data['browse_content_type'] = content_type
+        set_flow_state(
+            context.user_data, 'browse',
+            browse_chapter=chapter_id, browse_content_type=content_type
+        )
     
     # Admin Flow - Chapter Management
     elif data == "admin_chapters":
         await query.edit_message_text(
             "📖 *Chapter Management*\nSelect a subject:",
             parse_mode='Markdown',
-            reply_markup=get_subjects_keyboard()
+            reply_markup=get_subjects_keyboard("chapters")
         )
-        context.user_data['admin_mode'] = 'chapters'
     
-    elif data.startswith("subject_") and context.user_data.get('admin_mode') == 'chapters':
-        subject_code = data.split("_")[1]
-        session = Session()
-        subject = session.query(Subject).filter_by(code=subject_code).first()
+    elif data.startswith("chapters_subject_"):
+        subject_code = data.split("_")[2]
+        subject = await get_subject_by_code(subject_code)
         
         if subject:
-            context.user_data['admin_subject'] = subject.id
-            keyboard = get_chapters_keyboard(subject.id, "admin")
-            # Add "Add New Chapter" button
-            keyboard.inline_keyboard.insert(0, [
-                InlineKeyboardButton("➕ Add New Chapter", callback_data=f"add_chapter_{subject.id}")
-            ])
+            set_flow_state(context.user_data, 'admin_chapters', admin_subject=subject.id)
+            keyboard = await get_chapters_keyboard(subject.id, "admin")
             
             await query.edit_message_text(
                 f"📖 *{subject.name} - Chapters*\nManage chapters:",
                 parse_mode='Markdown',
                 reply_markup=keyboard
             )
-        session.close()
     
     elif data.startswith("add_chapter_"):
         subject_id = int(data.split("_")[2])
-        context.user_data['admin_subject'] = subject_id
-        context.user_data['awaiting_chapter_name'] = True
+        set_flow_state(
+            context.user_data, 'admin_chapters',
+            admin_subject=subject_id, awaiting_chapter_name=True
+        )
         
-        session = Session()
-        subject = session.query(Subject).get(subject_id)
-        session.close()
+        subject = await get_subject_by_id(subject_id)
         
         if subject:
             await query.edit_message_text(
@@ -239,8 +479,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     elif data.startswith("chapter_admin_"):
         chapter_id = int(data.split("_")[2])
-        session = Session()
-        chapter = session.query(Chapter).get(chapter_id)
+        chapter = await get_chapter_by_id(chapter_id)
         
         if chapter:
             keyboard = [
@@ -252,115 +491,104 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
                 parse_mode='Markdown',
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
-        session.close()
     
     elif data.startswith("delete_chapter_"):
         chapter_id = int(data.split("_")[2])
-        session = Session()
-        chapter = session.query(Chapter).get(chapter_id)
+        chapter = await get_chapter_by_id(chapter_id)
         
-        if chapter:
+        if chapter and await delete_chapter(chapter_id):
             chapter_name = chapter.name
-            subject_code = chapter.subject.code
-            subject_id = chapter.subject.id
-            session.delete(chapter)
-            session.commit()
+            subject = chapter.subject
             await query.answer(f"✅ Chapter '{chapter_name}' deleted successfully!")
             
             # Go back to subject's chapter list
-            subject = session.query(Subject).get(subject_id)
             if subject:
-                keyboard = get_chapters_keyboard(subject.id, "admin")
-                keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton("➕ Add New Chapter", callback_data=f"add_chapter_{subject.id}")
-                ])
+                keyboard = await get_chapters_keyboard(subject.id, "admin")
                 
                 await query.edit_message_text(
                     f"📖 *{subject.name} - Chapters*\nManage chapters:",
                     parse_mode='Markdown',
                     reply_markup=keyboard
                 )
-        session.close()
     
     # Admin Flow - Add Content
     elif data == "admin_add_content":
         await query.edit_message_text(
             "➕ *Add Content*\nSelect subject:",
             parse_mode='Markdown',
-            reply_markup=get_subjects_keyboard()
+            reply_markup=get_subjects_keyboard("add_content")
         )
-        context.user_data['admin_mode'] = 'add_content'
-        context.user_data['awaiting_content_subject'] = True
+        end_flow(context.user_data, 'admin_add_content')
+        set_flow_state(context.user_data, 'admin_add_content', awaiting_content_subject=True)
     
-    elif data.startswith("subject_") and context.user_data.get('admin_mode') == 'add_content':
-        subject_code = data.split("_")[1]
-        session = Session()
-        subject = session.query(Subject).filter_by(code=subject_code).first()
+    elif data.startswith("add_content_subject_"):
+        subject_code = data.split("_")[3]
+        subject = await get_subject_by_code(subject_code)
         
         if subject:
-            context.user_data['content_subject'] = subject.id
-            context.user_data['awaiting_content_subject'] = False
-            context.user_data['awaiting_content_chapter'] = True
+            set_flow_state(
+                context.user_data, 'admin_add_content',
+                content_subject=subject.id, awaiting_content_subject=False, awaiting_content_chapter=True
+            )
             
             await query.edit_message_text(
                 f"➕ *Add Content to {subject.name}*\nSelect chapter:",
                 parse_mode='Markdown',
-                reply_markup=get_chapters_keyboard(subject.id, "add_content")
+                reply_markup=await get_chapters_keyboard(subject.id, "add_content")
             )
-        session.close()
     
     elif data.startswith("chapter_add_content_"):
         chapter_id = int(data.split("_")[3])
-        context.user_data['content_chapter'] = chapter_id
-        context.user_data['awaiting_content_chapter'] = False
-        context.user_data['awaiting_content_type'] = True
+        set_flow_state(
+            context.user_data, 'admin_add_content',
+            content_chapter=chapter_id, awaiting_content_chapter=False, awaiting_content_type=True
+        )
         
-        session = Session()
-        chapter = session.query(Chapter).get(chapter_id)
-        session.close()
+        chapter = await get_chapter_by_id(chapter_id)
         
         if chapter:
-            keyboard = []
-            for code, name in config.CONTENT_TYPES.items():
-                keyboard.append([InlineKeyboardButton(name, callback_data=f"select_content_type_{chapter_id}_{code}")])
-            keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_add_content")])
-            
             await query.edit_message_text(
                 f"📚 *{chapter.name}*\nSelect content type:",
                 parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=get_content_types_keyboard(chapter_id, "add_content")
             )
     
     elif data.startswith("select_content_type_"):
         _, _, _, chapter_id, content_type = data.split("_")
         chapter_id = int(chapter_id)
         
-        context.user_data['content_chapter'] = chapter_id
-        context.user_data['content_type'] = content_type
-        context.user_data['awaiting_content_type'] = False
-        context.user_data['awaiting_content_number'] = True
+        set_flow_state(
+            context.user_data, 'admin_add_content',
+            content_chapter=chapter_id, content_type=content_type,
+            awaiting_content_type=False, awaiting_content_number=True
+        )
         
         await query.edit_message_text(
             f"Enter content number for {config.CONTENT_TYPES[content_type]}:"
         )
     
     # User Management
-    elif data == "admin_users":
-        session = Session()
-        users = session.query(User).order_by(User.created_at.desc()).limit(50).all()
-        session.close()
+    elif data == "admin_users" or data.startswith("users_"):
+        parts = data.split("_")
+        user_filter = parts[1] if data.startswith("users_") else "all"
         
-        await query.edit_message_text(
-            "👥 *User Management*\nSelect a user:",
-            parse_mode='Markdown',
-            reply_markup=get_user_management_keyboard(users)
-        )
+        if data == "users_search":
+            set_flow_state(context.user_data, 'user_search', awaiting_user_search=True)
+            await query.edit_message_text("🔍 Send a name, @username or user ID to search:")
+            return
+        
+        before_id = after_id = None
+        if len(parts) == 4:
+            if parts[2] == "next":
+                before_id = int(parts[3])
+            else:
+                after_id = int(parts[3])
+        
+        await show_users_page(query.edit_message_text, context, user_filter, before_id, after_id)
     
     elif data.startswith("user_detail_"):
         user_id = int(data.split("_")[2])
-        session = Session()
-        user = session.query(User).filter_by(user_id=user_id).first()
-        session.close()
+        user = await get_user_by_id(user_id)
         
         if user:
             status = "🚫 Blocked" if user.is_blocked else "✅ Active"
@@ -381,7 +609,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     elif data.startswith("block_user_"):
         user_id = int(data.split("_")[2])
-        block_user(user_id)
+        await block_user(user_id)
         await query.answer("✅ User blocked successfully!")
         await query.edit_message_reply_markup(
             get_user_action_keyboard(user_id, True)
@@ -389,12 +617,36 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     elif data.startswith("unblock_user_"):
         user_id = int(data.split("_")[2])
-        unblock_user(user_id)
+        await unblock_user(user_id)
         await query.answer("✅ User unblocked successfully!")
         await query.edit_message_reply_markup(
             get_user_action_keyboard(user_id, False)
         )
     
+    # Bulk Moderation
+    elif data == "admin_bulk":
+        await query.edit_message_text(
+            "🧹 *Bulk Actions*\nSelect an action (use /bulk for custom filters):",
+            parse_mode='Markdown',
+            reply_markup=get_bulk_actions_keyboard()
+        )
+    
+    elif data.startswith("bulk_run_"):
+        if user.id not in config.ADMIN_IDS:
+            return
+        action = data.split("_")[2]
+        await query.edit_message_text("⏳ Starting bulk action...")
+        context.application.create_task(
+            run_bulk_action(query.message, action, **BULK_PRESETS[action]), update=update
+        )
+    
+    elif data.startswith("bulk_"):
+        action = data.split("_")[1]
+        await query.edit_message_text(
+            f"⚠️ {describe_bulk_action(action, **BULK_PRESETS[action])}?",
+            reply_markup=get_bulk_confirm_keyboard(action)
+        )
+    
     # Navigation
     elif data == "back_to_main":
         await query.edit_message_text(
@@ -411,15 +663,13 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     elif data.startswith("back_to_chapters_"):
         chapter_id = int(data.split("_")[3])
-        session = Session()
-        chapter = session.query(Chapter).get(chapter_id)
+        chapter = await get_chapter_by_id(chapter_id)
         if chapter:
             await query.edit_message_text(
                 f"📚 *{chapter.name}*\nSelect content type:",
                 parse_mode='Markdown',
                 reply_markup=get_content_types_keyboard(chapter_id, "browse")
             )
-        session.close()
     
     elif data == "back_to_admin":
         await query.edit_message_text(
@@ -430,21 +680,35 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     elif data.startswith("back_to_subject_"):
         subject_code = data.split("_")[3]
-        session = Session()
-        subject = session.query(Subject).filter_by(code=subject_code).first()
+        subject = await get_subject_by_code(subject_code)
         
         if subject:
-            keyboard = get_chapters_keyboard(subject.id, "admin")
-            keyboard.inline_keyboard.insert(0, [
-                InlineKeyboardButton("➕ Add New Chapter", callback_data=f"add_chapter_{subject.id}")
-            ])
+            keyboard = await get_chapters_keyboard(subject.id, "admin")
             
             await query.edit_message_text(
                 f"📖 *{subject.name} - Chapters*\nManage chapters:",
                 parse_mode='Markdown',
                 reply_markup=keyboard
             )
-        session.close()
+
+async def show_users_page(reply, context, user_filter="all", before_id=None, after_id=None):
+    """Render one page of the admin user browser through reply (send or edit)"""
+    users, prev_cursor, next_cursor = await get_users_page(
+        user_filter, context.user_data.get('user_search'), before_id, after_id
+    )
+    
+    if user_filter == "blocked":
+        title = "👥 *User Management - Blocked*"
+    elif user_filter == "search":
+        title = "👥 *User Management - Search*"
+    else:
+        title = "👥 *User Management*"
+    
+    await reply(
+        f"{title}\n" + ("Select a user:" if users else "No users found."),
+        parse_mode='Markdown',
+        reply_markup=get_user_management_keyboard(users, user_filter, prev_cursor, next_cursor)
+    )
 
 async def handle_chapter_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle chapter name input from admin"""
@@ -472,42 +736,26 @@ async def handle_chapter_name_input(update: Update, context: ContextTypes.DEFAUL
         context.user_data.pop('awaiting_chapter_name', None)
         return
     
-    session = Session()
+    # Clear the flag before awaiting, so a second message can't add the chapter twice
+    context.user_data.pop('awaiting_chapter_name', None)
     
     # Check if chapter already exists
-    existing = session.query(Chapter).filter_by(
-        subject_id=subject_id,
-        name=chapter_name
-    ).first()
+    existing = await get_chapter_by_name(subject_id, chapter_name)
     
     if existing:
         await update.message.reply_text(f"❌ Chapter '{chapter_name}' already exists in this subject!")
-        session.close()
-        context.user_data.pop('awaiting_chapter_name', None)
         return
     
     # Add new chapter
-    new_chapter = Chapter(
-        subject_id=subject_id,
-        name=chapter_name
-    )
-    session.add(new_chapter)
-    session.commit()
+    await add_chapter(subject_id, chapter_name)
     
     # Get subject for display
-    subject = session.query(Subject).get(subject_id)
-    session.close()
-    
-    # Clear the flag
-    context.user_data.pop('awaiting_chapter_name', None)
+    subject = await get_subject_by_id(subject_id)
     
     await update.message.reply_text(f"✅ Chapter '{chapter_name}' added to {subject.name} successfully!")
     
     # Show updated chapter list
-    keyboard = get_chapters_keyboard(subject_id, "admin")
-    keyboard.inline_keyboard.insert(0, [
-        InlineKeyboardButton("➕ Add New Chapter", callback_data=f"add_chapter_{subject_id}")
-    ])
+    keyboard = await get_chapters_keyboard(subject_id, "admin")
     
     await update.message.reply_text(
         f"📖 *{subject.name} - Chapters*\nManage chapters:",
@@ -515,10 +763,82 @@ async def handle_chapter_name_input(update: Update, context: ContextTypes.DEFAUL
         reply_markup=keyboard
     )
 
+async def send_cached_content(bot, chat_id, content, file_id, caption):
+    """Send content by its Telegram file_id"""
+    if content.content_type == "lecture":
+        await bot.send_video(chat_id=chat_id, video=file_id, caption=caption)
+    else:
+        await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+
+async def report_undeliverable(bot, content):
+    """Tell admins (once per run) that a content can't be delivered"""
+    if content.id in _reported_undeliverable:
+        return
+    _reported_undeliverable.add(content.id)
+    
+    text = (
+        f"⚠️ {get_content_caption(content)} (chapter {content.chapter_id}) can't be delivered: "
+        f"Telegram rejected its file_id and there is no local copy. Please upload it again."
+    )
+    for admin_id in config.ADMIN_IDS:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text)
+        except TelegramError as e:
+            logger.warning(f"Could not notify admin {admin_id}: {e}")
+
+async def deliver_content(context: ContextTypes.DEFAULT_TYPE, chat_id, user_id, content):
+    """Send content to a chat, preferring the cached Telegram file_id
+    
+    Returns False if there is no usable file_id and the local file is missing.
+    """
+    caption = get_content_caption(content)
+    started = time.monotonic()
+    
+    # Try to send using file_id if available
+    delivery = None
+    file_id = content.file_id
+    if file_id:
+        try:
+            await send_cached_content(context.bot, chat_id, content, file_id, caption)
+            delivery = "file_id"
+        except BadRequest as e:
+            if not os.path.exists(content.file_path):
+                # The file_id is the only copy of the file; keep it and let an admin know
+                logger.error(f"Telegram rejected the file_id of content {content.id}, no local copy: {e}")
+                await report_undeliverable(context.bot, content)
+                return False
+            # Forget the stale file_id (unless a concurrent upload already replaced it)
+            # so the warm-up job replaces it if the upload below fails
+            if content.file_id == file_id:
+                await update_file_id(content.id, None)
+    
+    # Send using file path; concurrent requests share a single upload
+    if delivery is None:
+        if not os.path.exists(content.file_path):
+            return False
+        
+        file_id, uploaded = await upload_once(
+            content, lambda: upload_content(context.bot, chat_id, content, caption)
+        )
+        if uploaded:
+            delivery = "upload"
+        else:
+            await send_cached_content(context.bot, chat_id, content, file_id, caption)
+            delivery = "file_id"
+    
+    # Content that is being delivered again is hot; bring back an evicted local copy
+    if delivery == "file_id" and content.file_path and not os.path.exists(content.file_path) \
+            and has_room_for_rehydration():
+        context.application.create_task(mirror_content(context.bot, content.id))
+    
+    await log_user_action(user_id, f"downloaded_{content.content_type}_{content.content_number}")
+    await log_content_access(user_id, content, delivery, int((time.monotonic() - started) * 1000))
+    return True
+
 async def send_content_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle content number input from user"""
     user = update.effective_user
-    db_user = get_user(user.id, user.username, user.first_name, user.last_name)
+    db_user = await get_user(user.id, user.username, user.first_name, user.last_name)
     
     if db_user.is_blocked and user.id not in config.ADMIN_IDS:
         await update.message.reply_text("🚫 You are currently blocked. Please try again later.")
@@ -533,78 +853,16 @@ async def send_content_number(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ Error: Please start over from the beginning.")
             return
         
-        session = Session()
-        content = session.query(Content).filter_by(
-            chapter_id=chapter_id,
-            content_type=content_type,
-            content_number=content_number
-        ).first()
+        content = await get_content_by_details(chapter_id, content_type, content_number)
         
         if content:
-            # Try to send using file_id if available
-            if content.file_id:
-                try:
-                    if content_type == "lecture":
-                        await context.bot.send_video(
-                            chat_id=update.effective_chat.id,
-                            video=content.file_id,
-                            caption=f"🎥 Lecture #{content_number}"
-                        )
-                    else:
-                        await context.bot.send_document(
-                            chat_id=update.effective_chat.id,
-                            document=content.file_id,
-                            caption=f"📄 {config.CONTENT_TYPES[content_type]} #{content_number}"
-                        )
-                    log_user_action(user.id, f"downloaded_{content_type}_{content_number}")
-                    
-                    # Clear the context
-                    context.user_data.pop('browse_chapter', None)
-                    context.user_data.pop('browse_content_type', None)
-                    
-                    # Show subject selection again
-                    await update.message.reply_text(
-                        "📚 Select a Subject:",
-                        reply_markup=get_subjects_keyboard()
-                    )
-                    
-                    session.close()
-                    return
-                except BadRequest:
-                    pass  # Fall back to file path
-            
-            # Send using file path
-            if os.path.exists(content.file_path):
-                if content_type == "lecture":
-                    with open(content.file_path, 'rb') as file:
-                        msg = await context.bot.send_video(
-                            chat_id=update.effective_chat.id,
-                            video=file,
-                            caption=f"🎥 Lecture #{content_number}"
-                        )
-                        # Save file_id for future use
-                        content.file_id = msg.video.file_id
-                else:
-                    with open(content.file_path, 'rb') as file:
-                        msg = await context.bot.send_document(
-                            chat_id=update.effective_chat.id,
-                            document=file,
-                            caption=f"📄 {config.CONTENT_TYPES[content_type]} #{content_number}"
-                        )
-                        content.file_id = msg.document.file_id
-                
-                session.commit()
-                log_user_action(user.id, f"downloaded_{content_type}_{content_number}")
-            else:
+            if not await deliver_content(context, update.effective_chat.id, user.id, content):
                 await update.message.reply_text("❌ File not found. Please contact admin.")
         else:
             await update.message.reply_text(f"❌ Content #{content_number} not found for selected type.")
         
-        session.close()
-        
         # Clear the context
-        context.user_data.pop('browse_chapter', None)
-        context.user_data.pop('browse_content_type', None)
+        end_flow(context.user_data, 'browse')
         
         # Show subject selection again
         await update.message.reply_text(
@@ -616,7 +874,7 @@ async def send_content_number(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Please enter a valid number.")
         # Don't add warning for admin
         if user.id not in config.ADMIN_IDS:
-            add_warning(user.id)
+            await add_warning(user.id)
 
 async def enter_content_number_admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle content number input for admin adding content"""
@@ -632,26 +890,22 @@ async def enter_content_number_admin_handler(update: Update, context: ContextTyp
     
     try:
         content_number = int(update.message.text)
-        context.user_data['content_number'] = content_number
+        set_flow_state(context.user_data, 'admin_add_content', content_number=content_number)
         
         # Clear the flag
         context.user_data.pop('awaiting_content_number', None)
         
         # Check if content already exists
-        session = Session()
-        existing = session.query(Content).filter_by(
-            chapter_id=context.user_data['content_chapter'],
-            content_type=context.user_data['content_type'],
-            content_number=content_number
-        ).first()
+        existing = await get_content_by_details(
+            context.user_data['content_chapter'],
+            context.user_data['content_type'],
+            content_number
+        )
         
         if existing:
             await update.message.reply_text("❌ Content with this number already exists!")
-            session.close()
             return
         
-        session.close()
-        
         # Ask for file
         content_type = context.user_data['content_type']
         file_type = "MP4 video" if content_type == "lecture" else "PDF"
@@ -660,7 +914,7 @@ async def enter_content_number_admin_handler(update: Update, context: ContextTyp
             f"Please send the {file_type} file for {config.CONTENT_TYPES[content_type]} #{content_number}\n\n"
             f"Format: {'Video (MP4)' if content_type == 'lecture' else 'PDF'}"
         )
-        context.user_data['awaiting_content_file'] = True
+        set_flow_state(context.user_data, 'admin_add_content', awaiting_content_file=True)
         
     except ValueError:
         await update.message.reply_text("❌ Please enter a valid number.")
@@ -702,42 +956,77 @@ async def save_content_file_handler(update: Update, context: ContextTypes.DEFAUL
         )
         return
     
-    # Save file
-    file_obj = await file.get_file()
-    file_path = save_file(
-        file_obj,
-        context.user_data['content_type'],
-        context.user_data['content_chapter'],
-        context.user_data['content_number']
-    )
+    # Other updates may end the flow while this one awaits; keep what it needs
+    chapter_id = context.user_data['content_chapter']
+    content_type = context.user_data['content_type']
+    content_number = context.user_data['content_number']
+    
+    # Saving runs concurrently with other updates; don't take a second file meanwhile
+    set_flow_state(context.user_data, 'admin_add_content', awaiting_content_file=False)
+    
+    if config.INGEST_MODE == "telegram":
+        # Publish straight from the message; the bytes already live on Telegram
+        content = await add_content(
+            chapter_id,
+            content_type,
+            content_number,
+            file_size=file.file_size,
+            file_id=file.file_id,
+            file_unique_id=file.file_unique_id
+        )
+        if content and config.MIRROR_FILES:
+            context.application.create_task(mirror_content(context.bot, content.id))
+    else:
+        # Save file
+        try:
+            file_obj = await file.get_file()
+        except BadRequest as e:
+            # e.g. over the Bot API's download size limit
+            set_flow_state(context.user_data, 'admin_add_content', awaiting_content_file=True)
+            await update.message.reply_text(f"❌ Telegram won't hand out this file: {e}")
+            return
+        
+        await update.message.reply_text("⏳ Saving file...")
+        saved = await save_file(file_obj, content_type)
+        
+        if not saved:
+            set_flow_state(context.user_data, 'admin_add_content', awaiting_content_file=True)
+            await update.message.reply_text("❌ Error saving file. Please send it again.")
+            return
+        file_path, file_size, file_sha256 = saved
+        
+        # Save to database
+        content = await add_content(
+            chapter_id,
+            content_type,
+            content_number,
+            file_path,
+            file_size,
+            file_sha256,
+            file_unique_id=file.file_unique_id
+        )
+        
+        # Get a file_id in the background so no student pays for the first upload
+        if content:
+            context.application.create_task(warm_up_content(context.bot, content.id))
     
-    if not file_path:
-        await update.message.reply_text("❌ Error saving file.")
+    if not content:
+        end_flow(context.user_data, 'admin_add_content')
+        await update.message.reply_text(
+            f"❌ {config.CONTENT_TYPES[content_type]} #{content_number} was added by someone else meanwhile."
+        )
         return
     
-    # Save to database
-    session = Session()
-    new_content = Content(
-        chapter_id=context.user_data['content_chapter'],
-        content_type=context.user_data['content_type'],
-        content_number=context.user_data['content_number'],
-        file_path=file_path
-    )
-    session.add(new_content)
-    session.commit()
-    
     # Get chapter and subject names for success message
-    chapter = session.query(Chapter).get(context.user_data['content_chapter'])
+    chapter = await get_chapter_by_id(chapter_id)
     subject = chapter.subject if chapter else None
-    session.close()
     
     # Clear all context flags
-    for key in ['awaiting_content_file', 'content_chapter', 'content_type', 'content_number']:
-        context.user_data.pop(key, None)
+    end_flow(context.user_data, 'admin_add_content')
     
-    success_msg = f"✅ {config.CONTENT_TYPES[context.user_data['content_type']]} #{context.user_data['content_number']} added successfully!"
+    success_msg = f"✅ {config.CONTENT_TYPES[content_type]} #{content_number} added successfully!"
     if subject and chapter:
-        success_msg = f"✅ {config.CONTENT_TYPES[context.user_data['content_type']]} #{context.user_data['content_number']} added to {subject.name} > {chapter.name} successfully!"
+        success_msg = f"✅ {config.CONTENT_TYPES[content_type]} #{content_number} added to {subject.name} > {chapter.name} successfully!"
     
     await update.message.reply_text(success_msg)
     
@@ -1,6 +1,15 @@
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from catalog import get_catalog_version
 import config
 
+# Markups are immutable in python-telegram-bot 20, so rendered keyboards are
+# built once and shared. Static ones are memoized with lru_cache; chapter
+# keyboards depend on the catalog and are cached per catalog version.
+_chapter_keyboards = {}
+_chapter_keyboards_version = None
+
+@lru_cache(maxsize=None)
 def get_main_menu_keyboard(is_admin=False):
     if is_admin:
         buttons = [
@@ -15,20 +24,45 @@ def get_main_menu_keyboard(is_admin=False):
         ]
     return ReplyKeyboardMarkup(buttons, resize_keyboard=True, input_field_placeholder="Select an option...")
 
-def get_subjects_keyboard():
+@lru_cache(maxsize=None)
+def get_subjects_keyboard(action="browse"):
     keyboard = []
     for code, name in config.SUBJECTS.items():
-        keyboard.append([InlineKeyboardButton(name, callback_data=f"subject_{code}")])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_main")])
+        if action == "browse":
+            callback_data = f"subject_{code}"
+        else:
+            callback_data = f"{action}_subject_{code}"
+        keyboard.append([InlineKeyboardButton(name, callback_data=callback_data)])
+    
+    back_callback = "back_to_main" if action == "browse" else "back_to_admin"
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=back_callback)])
     return InlineKeyboardMarkup(keyboard)
 
-def get_chapters_keyboard(subject_id, action="browse"):
-    from database import Session, Chapter
-    session = Session()
-    chapters = session.query(Chapter).filter_by(subject_id=subject_id).all()
-    session.close()
+async def get_chapters_keyboard(subject_id, action="browse"):
+    global _chapter_keyboards_version
+    version = get_catalog_version()
+    if version != _chapter_keyboards_version:
+        _chapter_keyboards.clear()
+        _chapter_keyboards_version = version
+    
+    key = (subject_id, action)
+    if key in _chapter_keyboards:
+        return _chapter_keyboards[key]
+    
+    from utils import get_all_chapters
+    chapters = await get_all_chapters(subject_id)
+    keyboard = _build_chapters_keyboard(subject_id, action, chapters)
     
+    # Don't cache a keyboard built from a catalog that changed meanwhile
+    if version == get_catalog_version():
+        _chapter_keyboards[key] = keyboard
+    return keyboard
+
+def _build_chapters_keyboard(subject_id, action, chapters):
     keyboard = []
+    if action == "admin":
+        keyboard.append([InlineKeyboardButton("➕ Add New Chapter", callback_data=f"add_chapter_{subject_id}")])
+    
     for chapter in chapters:
         if action == "browse":
             callback_data = f"chapter_browse_{chapter.id}"
@@ -39,12 +73,13 @@ def get_chapters_keyboard(subject_id, action="browse"):
     if action == "browse":
         keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_subjects")])
     elif action == "admin":
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=f"back_to_subject_{subject_id}")])
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_chapters")])
     elif action == "add_content":
         keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_add_content")])
     
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1024)
 def get_content_types_keyboard(chapter_id, action="browse"):
     keyboard = []
     for code, name in config.CONTENT_TYPES.items():
@@ -53,19 +88,55 @@ def get_content_types_keyboard(chapter_id, action="browse"):
         else:
             callback_data = f"select_content_type_{chapter_id}_{code}"
         keyboard.append([InlineKeyboardButton(name, callback_data=callback_data)])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=f"back_to_chapters_{chapter_id}")])
+    if action == "browse":
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=f"back_to_chapters_{chapter_id}")])
+    else:
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_add_content")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_search_results_keyboard(results):
+    keyboard = []
+    for kind, item, chapter in results:
+        if kind == "chapter":
+            btn_text = f"📖 {chapter.subject.name} › {chapter.name}"
+            callback_data = f"chapter_browse_{chapter.id}"
+        else:
+            btn_text = f"{config.CONTENT_TYPES[item.content_type]} #{item.content_number} · {chapter.name}"
+            callback_data = f"content_get_{item.id}"
+        keyboard.append([InlineKeyboardButton(btn_text, callback_data=callback_data)])
+    keyboard.append([InlineKeyboardButton("📚 Browse Subjects", callback_data="back_to_subjects")])
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_admin_keyboard():
     keyboard = [
         [InlineKeyboardButton("📖 Add/Delete Chapter", callback_data="admin_chapters")],
         [InlineKeyboardButton("➕ Add Content", callback_data="admin_add_content")],
         [InlineKeyboardButton("👥 Manage Users", callback_data="admin_users")],
+        [InlineKeyboardButton("🧹 Bulk Actions", callback_data="admin_bulk")],
         [InlineKeyboardButton("🔙 Back to Main", callback_data="back_to_main")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_user_management_keyboard(users):
+@lru_cache(maxsize=None)
+def get_bulk_actions_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("🧹 Clear All Warnings", callback_data="bulk_clear")],
+        [InlineKeyboardButton(f"🚫 Block Users With {config.MAX_WARNINGS - 1}+ Warnings", callback_data="bulk_block")],
+        [InlineKeyboardButton("✅ Unblock All Users", callback_data="bulk_unblock")],
+        [InlineKeyboardButton("🔙 Back", callback_data="back_to_admin")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=None)
+def get_bulk_confirm_keyboard(action):
+    keyboard = [
+        [InlineKeyboardButton("✅ Confirm", callback_data=f"bulk_run_{action}")],
+        [InlineKeyboardButton("🔙 Cancel", callback_data="admin_bulk")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_user_management_keyboard(users, user_filter="all", prev_cursor=None, next_cursor=None):
     keyboard = []
     for user in users:
         status = "🚫 Blocked" if user.is_blocked else "✅ Active"
@@ -73,9 +144,25 @@ def get_user_management_keyboard(users):
         keyboard.append([
             InlineKeyboardButton(btn_text, callback_data=f"user_detail_{user.user_id}")
         ])
+    
+    # Page navigation carries the keyset cursor in the callback data
+    nav = []
+    if prev_cursor is not None:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"users_{user_filter}_prev_{prev_cursor}"))
+    if next_cursor is not None:
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"users_{user_filter}_next_{next_cursor}"))
+    if nav:
+        keyboard.append(nav)
+    
+    if user_filter == "all":
+        filter_button = InlineKeyboardButton("🚫 Blocked Only", callback_data="users_blocked")
+    else:
+        filter_button = InlineKeyboardButton("👥 All Users", callback_data="users_all")
+    keyboard.append([filter_button, InlineKeyboardButton("🔍 Search", callback_data="users_search")])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_admin")])
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=1024)
 def get_user_action_keyboard(user_id, is_blocked):
     keyboard = []
     if is_blocked:
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import os
+from telegram.error import TelegramError
+import config
+from utils import get_all_contents, get_content_by_id, save_file, set_content_file
+
+logger = logging.getLogger(__name__)
+
+# With INGEST_MODE = "telegram" content is published straight from the admin's
+# message file_id, and the bytes are copied to local storage afterwards. The
+# local copy is only a fallback for when Telegram rejects the file_id.
+
+# Content the Bot API refused to hand out (e.g. over its download size limit);
+# not retried until restart
+_unavailable = set()
+# Content being downloaded right now
+_in_flight = set()
+
+async def mirror_content(bot, content_id):
+    """Download a content file from Telegram into local storage; returns True if mirrored
+    
+    Also restores files evicted by the storage manager, in place.
+    """
+    content = await get_content_by_id(content_id)
+    if not content or not content.file_id or content_id in _in_flight or content_id in _unavailable \
+            or os.path.exists(content.file_path):
+        return False
+    
+    _in_flight.add(content_id)
+    try:
+        try:
+            file = await bot.get_file(content.file_id)
+        except TelegramError as e:
+            _unavailable.add(content_id)
+            logger.warning(f"Cannot mirror content {content_id}: {e}")
+            return False
+        
+        saved = await save_file(file, content.content_type)
+    finally:
+        _in_flight.discard(content_id)
+    
+    if not saved:
+        return False
+    if saved[0] == content.file_path:
+        return True  # Evicted blob restored
+    return await set_content_file(content_id, *saved)
+
+async def mirror_missing(bot, limit=None):
+    """Mirror up to limit content items that have no local copy; returns how many"""
+    pending = [
+        content.id for content in await get_all_contents()
+        # Evicted files (file_path set but missing) come back on demand instead
+        if content.file_id and content.id not in _unavailable and not content.file_path
+    ]
+    mirrored = 0
+    for content_id in pending[:limit or config.MIRROR_BATCH_SIZE]:
+        if await mirror_content(bot, content_id):
+            mirrored += 1
+        await asyncio.sleep(0)
+    
+    return mirrored
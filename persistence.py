@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import select, delete, insert
+from telegram.ext import BasePersistence, PersistenceInput
+from database import AsyncSession, UserState
+import config
+
+logger = logging.getLogger(__name__)
+
+class DatabasePersistence(BasePersistence):
+    """Keep context.user_data in the user_states table
+    
+    A user's state is read the first time one of their updates is handled,
+    not at startup. On each persistence run only users whose serialized state
+    differs from what was last stored are written, in one transaction.
+    Chat data, bot data, callback data and conversations are not persisted.
+    """
+    
+    def __init__(self, update_interval=None):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval or config.STATE_FLUSH_INTERVAL
+        )
+        # JSON last read from / written to the database, per loaded user
+        self._stored = {}
+        # Users whose state changed since the last write: JSON, or None to delete
+        self._dirty = {}
+        self._write_lock = asyncio.Lock()
+    
+    async def _write_dirty(self):
+        """Write all pending state changes in one transaction"""
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            
+            dirty = self._dirty
+            self._dirty = {}
+            now = datetime.utcnow()
+            rows = [
+                {'user_id': user_id, 'data': data, 'updated_at': now}
+                for user_id, data in dirty.items() if data is not None
+            ]
+            
+            async with AsyncSession() as session:
+                try:
+                    await session.execute(delete(UserState).filter(UserState.user_id.in_(dirty)))
+                    if rows:
+                        await session.execute(insert(UserState), rows)
+                    await session.commit()
+                except Exception as e:
+                    await session.rollback()
+                    # Newer changes queued meanwhile win over the failed ones
+                    self._dirty = {**dirty, **self._dirty}
+                    logger.error(f"Error writing conversation state: {e}")
+                    return
+            
+            for user_id, data in dirty.items():
+                if data is None:
+                    # Dropped users are forgotten; their state is reloaded if they come back
+                    self._stored.pop(user_id, None)
+                else:
+                    self._stored[user_id] = data
+    
+    async def get_user_data(self):
+        # Loaded lazily in refresh_user_data
+        return {}
+    
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._stored:
+            return
+        
+        async with AsyncSession() as session:
+            data = await session.scalar(select(UserState.data).filter_by(user_id=user_id))
+        
+        # Keys set before the load finished take precedence
+        if data is not None:
+            for key, value in json.loads(data).items():
+                user_data.setdefault(key, value)
+        self._stored[user_id] = data
+    
+    async def update_user_data(self, user_id, data):
+        # Never overwrite state that was not loaded in this process
+        if user_id not in self._stored:
+            return
+        
+        serialized = json.dumps(data, sort_keys=True) if data else None
+        if serialized == self._stored[user_id]:
+            self._dirty.pop(user_id, None)
+            return
+        
+        self._dirty[user_id] = serialized
+        await self._write_dirty()
+    
+    async def drop_user_data(self, user_id):
+        self._dirty[user_id] = None
+        await self._write_dirty()
+    
+    async def flush(self):
+        await self._write_dirty()
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name):
+        return {}
+    
+    async def update_conversation(self, name, key, new_state):
+        pass
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
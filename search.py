@@ -0,0 +1,135 @@
+import re
+from sqlalchemy import select, delete, text
+from database import AsyncSession, async_engine, SearchDocument, Subject, Chapter, Content
+import config
+
+# Chapters and contents are mirrored into search_documents (one row per item)
+# whenever they are added or deleted. The table is indexed per dialect:
+# - SQLite: an FTS5 external-content table kept in sync by triggers
+# - PostgreSQL: a generated tsvector column (GIN) plus a pg_trgm index on the
+#   title for typo-tolerant matches
+
+def chapter_document(chapter, subject):
+    """Searchable (title, body) for a chapter"""
+    return chapter.name, f"{subject.name} {subject.code}"
+
+def content_document(content, chapter, subject):
+    """Searchable (title, body) for a content item"""
+    label = config.CONTENT_TYPES.get(content.content_type, content.content_type)
+    return (
+        f"{chapter.name} {content.content_type} {content.content_number}",
+        f"{subject.name} {subject.code} {label} #{content.content_number}"
+    )
+
+def _sqlite_ddl():
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+        "title, body, content='search_documents', content_rowid='id', "
+        "prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS search_documents_ai AFTER INSERT ON search_documents BEGIN "
+        "INSERT INTO search_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+        "CREATE TRIGGER IF NOT EXISTS search_documents_ad AFTER DELETE ON search_documents BEGIN "
+        "INSERT INTO search_fts(search_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); END",
+        "CREATE TRIGGER IF NOT EXISTS search_documents_au AFTER UPDATE ON search_documents BEGIN "
+        "INSERT INTO search_fts(search_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); "
+        "INSERT INTO search_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+    ]
+
+def _postgresql_ddl():
+    return [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "ALTER TABLE search_documents ADD COLUMN IF NOT EXISTS document tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', title || ' ' || body)) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_search_documents_document ON search_documents USING gin (document)",
+        "CREATE INDEX IF NOT EXISTS ix_search_documents_title_trgm ON search_documents USING gin (title gin_trgm_ops)",
+    ]
+
+def create_search_index(connection):
+    """Create the dialect's full-text index and backfill it (sync, used by migrations)"""
+    if connection.dialect.name == 'sqlite':
+        statements = _sqlite_ddl()
+    elif connection.dialect.name == 'postgresql':
+        statements = _postgresql_ddl()
+    else:
+        statements = []
+    for statement in statements:
+        connection.execute(text(statement))
+
+    # Explicit columns only: this runs inside a schema migration, so it must
+    # not depend on columns later migrations add to the models
+    connection.execute(delete(SearchDocument))
+    subjects = {
+        subject.id: subject
+        for subject in connection.execute(select(Subject.id, Subject.name, Subject.code)).all()
+    }
+    chapters = {
+        chapter.id: chapter
+        for chapter in connection.execute(select(Chapter.id, Chapter.subject_id, Chapter.name)).all()
+    }
+    documents = []
+    for chapter in chapters.values():
+        title, body = chapter_document(chapter, subjects[chapter.subject_id])
+        documents.append({'kind': 'chapter', 'ref_id': chapter.id, 'title': title, 'body': body})
+    content_rows = connection.execute(
+        select(Content.id, Content.chapter_id, Content.content_type, Content.content_number)
+    ).all()
+    for content in content_rows:
+        chapter = chapters[content.chapter_id]
+        title, body = content_document(content, chapter, subjects[chapter.subject_id])
+        documents.append({'kind': 'content', 'ref_id': content.id, 'title': title, 'body': body})
+    if documents:
+        connection.execute(SearchDocument.__table__.insert(), documents)
+
+def index_chapter(session, chapter, subject):
+    """Add a chapter to the search index inside the caller's transaction"""
+    title, body = chapter_document(chapter, subject)
+    session.add(SearchDocument(kind='chapter', ref_id=chapter.id, title=title, body=body))
+
+def index_content(session, content, chapter, subject):
+    """Add a content item to the search index inside the caller's transaction"""
+    title, body = content_document(content, chapter, subject)
+    session.add(SearchDocument(kind='content', ref_id=content.id, title=title, body=body))
+
+async def remove_documents(session, kind, ref_ids):
+    """Drop items from the search index inside the caller's transaction"""
+    if not ref_ids:
+        return
+    await session.execute(
+        delete(SearchDocument)
+        .filter(SearchDocument.kind == kind, SearchDocument.ref_id.in_(ref_ids))
+        .execution_options(synchronize_session=False)
+    )
+
+async def search_documents(term, limit=None):
+    """Ranked (kind, ref_id) matches for a free-text query"""
+    limit = limit or config.SEARCH_RESULTS_LIMIT
+    tokens = re.findall(r"\w+", term.lower())
+    if not tokens:
+        return []
+
+    dialect = async_engine.dialect.name
+    if dialect == 'sqlite':
+        # Every token must match, as a prefix; title weighs more than body
+        query = text(
+            "SELECT d.kind, d.ref_id FROM search_fts "
+            "JOIN search_documents d ON d.id = search_fts.rowid "
+            "WHERE search_fts MATCH :match "
+            "ORDER BY bm25(search_fts, 10.0, 1.0) LIMIT :limit"
+        )
+        params = {'match': " ".join(f'"{token}"*' for token in tokens), 'limit': limit}
+    elif dialect == 'postgresql':
+        query = text(
+            "SELECT kind, ref_id FROM search_documents "
+            "WHERE document @@ to_tsquery('simple', :match) OR title % :term "
+            "ORDER BY ts_rank(document, to_tsquery('simple', :match)) + similarity(title, :term) DESC "
+            "LIMIT :limit"
+        )
+        params = {'match': " & ".join(f"{token}:*" for token in tokens), 'term': term, 'limit': limit}
+    else:
+        query = select(SearchDocument.kind, SearchDocument.ref_id) \
+            .filter(SearchDocument.title.ilike(f"%{term}%")) \
+            .limit(limit)
+        params = {}
+
+    async with AsyncSession() as session:
+        return [(row[0], row[1]) for row in (await session.execute(query, params)).all()]
@@ -0,0 +1,110 @@
+import json
+import time
+import config
+
+# context.user_data keys owned by each multi-step flow. A flow is dropped as a
+# whole once it has gone config.FLOW_STATE_TTL[flow] seconds without being
+# advanced, so abandoned flows neither pile up in memory nor catch unrelated
+# messages later on.
+FLOWS = {
+    'browse': ('browse_chapter', 'browse_content_type'),
+    'admin_chapters': ('admin_subject', 'awaiting_chapter_name'),
+    'admin_add_content': (
+        'awaiting_content_subject', 'awaiting_content_chapter', 'awaiting_content_type',
+        'awaiting_content_number', 'awaiting_content_file',
+        'content_subject', 'content_chapter', 'content_type', 'content_number'
+    ),
+    'user_search': ('awaiting_user_search', 'user_search'),
+}
+
+# When each flow was last advanced (wall clock, so it survives restarts)
+FLOW_TIMES_KEY = 'flow_times'
+
+# Monotonic time of each user's latest update; the sweeper leaves recently
+# seen users in memory so it can't drop state a running handler is using
+_last_seen = {}
+
+def set_flow_state(user_data, flow, **values):
+    """Set keys of a flow and mark it as advanced now"""
+    user_data.update(values)
+    user_data.setdefault(FLOW_TIMES_KEY, {})[flow] = time.time()
+
+def end_flow(user_data, flow):
+    """Drop all state of a flow"""
+    for key in FLOWS[flow]:
+        user_data.pop(key, None)
+    
+    flow_times = user_data.get(FLOW_TIMES_KEY)
+    if flow_times is not None:
+        flow_times.pop(flow, None)
+        if not flow_times:
+            del user_data[FLOW_TIMES_KEY]
+
+def expire_flows(user_data, now=None):
+    """End flows idle for longer than their TTL; returns how many"""
+    now = now or time.time()
+    expired = 0
+    for flow, keys in FLOWS.items():
+        active = any(key in user_data for key in keys)
+        started = user_data.get(FLOW_TIMES_KEY, {}).get(flow)
+        
+        if active and started is None:
+            # State from before flows were timed; start the clock now
+            user_data.setdefault(FLOW_TIMES_KEY, {})[flow] = now
+        elif not active or now - started > config.FLOW_STATE_TTL[flow]:
+            if active:
+                expired += 1
+            end_flow(user_data, flow)
+    
+    return expired
+
+def touch_user(user_id):
+    """Record that an update from this user is being handled"""
+    _last_seen[user_id] = time.monotonic()
+
+def sweep_user_data(application):
+    """Expire stale flows for every user in memory and forget users left without state
+    
+    Returns the number of flows expired.
+    """
+    now = time.time()
+    idle_since = time.monotonic() - config.STATE_SWEEP_INTERVAL
+    expired = 0
+    changed = []
+    
+    for user_id, user_data in list(application.user_data.items()):
+        count = expire_flows(user_data, now)
+        if count:
+            expired += count
+            changed.append(user_id)
+        if not user_data and _last_seen.get(user_id, 0) < idle_since:
+            application.drop_user_data(user_id)
+            _last_seen.pop(user_id, None)
+    
+    # Write the expiries through to the persistence backend on its next run
+    if changed and application.persistence:
+        application.mark_data_for_update_persistence(
+            user_ids=[user_id for user_id in changed if user_id in application.user_data]
+        )
+    return expired
+
+def get_state_stats(application):
+    """Users held in memory, per-flow live counts and approximate state size"""
+    flows = {flow: 0 for flow in FLOWS}
+    users = 0
+    size = 0
+    for user_data in application.user_data.values():
+        if not user_data:
+            continue
+        users += 1
+        size += len(json.dumps(user_data, default=str))
+        for flow, keys in FLOWS.items():
+            if any(key in user_data for key in keys):
+                flows[flow] += 1
+    
+    return {
+        'loaded_users': len(application.user_data),
+        'users_with_state': users,
+        'flows': flows,
+        'state_bytes': size,
+    }
@@ -0,0 +1,75 @@
+import os
+from sqlalchemy import select, func, or_
+from database import AsyncSession, Blob, Content, ContentAccessEvent
+from blobs import remove_files
+from utils import check_storage_space
+import config
+
+# Local copies are a cache in front of Telegram: when free space drops below
+# STORAGE_MIN_FREE_MB, local files are unlinked least recently delivered first
+# until STORAGE_TARGET_FREE_MB is free again. That covers blobs and files
+# stored before content was hashed, but only those whose contents all have a
+# file_id (a rejected file_id is cleared on delivery, so a set one is assumed
+# good) and that are within DOWNLOAD_SIZE_LIMIT, so they can be fetched back.
+# Blob rows and Content.file_path are kept, so an evicted file is restored by
+# mirror.mirror_content when it is delivered again while there is room; a
+# pre-hash file comes back as a blob.
+
+def has_room_for_rehydration():
+    """Whether evicted files may be brought back without causing new evictions"""
+    return check_storage_space(config.STORAGE_TARGET_FREE_MB)[0]
+
+async def get_eviction_candidates():
+    """Local copies that can be re-fetched from Telegram, least recently delivered first"""
+    last_access = func.coalesce(func.max(ContentAccessEvent.timestamp), Blob.created_at)
+    blobs = (
+        select(Blob.file_path, last_access.label('last_access'))
+        .join(Content, Content.file_sha256 == Blob.sha256)
+        .outerjoin(ContentAccessEvent, ContentAccessEvent.content_id == Content.id)
+        .group_by(Blob.sha256, Blob.file_path, Blob.created_at)
+        # Every content using the blob has a file_id
+        .having(func.count(Content.id) == func.count(Content.file_id))
+    )
+    if config.DOWNLOAD_SIZE_LIMIT:
+        blobs = blobs.filter(Blob.size <= config.DOWNLOAD_SIZE_LIMIT)
+    # Files stored before content was hashed belong to their content alone
+    legacy_access = func.coalesce(func.max(ContentAccessEvent.timestamp), Content.created_at)
+    legacy = (
+        select(Content.file_path, legacy_access.label('last_access'))
+        .outerjoin(ContentAccessEvent, ContentAccessEvent.content_id == Content.id)
+        .filter(Content.file_sha256.is_(None), Content.file_path != '', Content.file_id.isnot(None))
+        .group_by(Content.id, Content.file_path, Content.created_at)
+    )
+    if config.DOWNLOAD_SIZE_LIMIT:
+        # Sizes weren't recorded before hashing either; evict_cold_files checks the file
+        legacy = legacy.filter(or_(Content.file_size.is_(None), Content.file_size <= config.DOWNLOAD_SIZE_LIMIT))
+    async with AsyncSession() as session:
+        candidates = (await session.execute(blobs)).all() + (await session.execute(legacy)).all()
+    return sorted(candidates, key=lambda row: row.last_access)
+
+async def evict_cold_files():
+    """Free disk space by dropping local copies of cold content
+    
+    Returns (files evicted, bytes freed).
+    """
+    enough_space, free_mb = check_storage_space(config.STORAGE_MIN_FREE_MB)
+    if enough_space:
+        return 0, 0
+    
+    needed = (config.STORAGE_TARGET_FREE_MB - free_mb) * 1024 * 1024
+    evicted = 0
+    freed = 0
+    for candidate in await get_eviction_candidates():
+        if freed >= needed:
+            break
+        if not os.path.exists(candidate.file_path):
+            continue  # Already evicted
+        
+        size = os.path.getsize(candidate.file_path)
+        if config.DOWNLOAD_SIZE_LIMIT and size > config.DOWNLOAD_SIZE_LIMIT:
+            continue  # Couldn't be fetched back from Telegram
+        remove_files([candidate.file_path])
+        evicted += 1
+        freed += size
+    
+    return evicted, freed
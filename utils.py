@@ -1,200 +1,381 @@
 import os
 import shutil
+import asyncio
+import hashlib
+import uuid
+import time
 from datetime import datetime, timedelta
-from database import Session, User, UserAction, Chapter, Content, Subject
+from urllib.parse import urlparse
+import aiofiles
+import aiofiles.os
+import httpx
+from sqlalchemy import select, insert, update, func, and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from database import AsyncSession, upsert, User, UserAction, ContentAccessEvent, Chapter, Content, Subject, Blob
+from cache import TTLCache
+from catalog import get_catalog, invalidate_catalog, set_content_file_id, update_catalog_content
+from counters import (
+    bump_counters, content_deltas, get_counters, today_start,
+    active_day, subject_chapters, subject_contents, type_contents
+)
+from analytics import count_user_actions, get_daily_actions
+from search import index_chapter, index_content, remove_documents, search_documents
+from blobs import (
+    blob_path, get_blob_path, get_shared_file_id, acquire_blob, release_blobs, remove_files
+)
 import config
 
-def get_user(user_id, username=None, first_name=None, last_name=None):
+# Detached User rows by Telegram user ID, so the per-message blocked check
+# doesn't hit the database. Moderation helpers below write through to it, and
+# expire_blocks() evicts users whose block it lifts.
+_user_cache = TTLCache(maxsize=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+
+def _get_user_updates(user, now, username=None, first_name=None, last_name=None):
+    """Return the columns get_user needs to write for this user"""
+    updates = {}
+    
+    # Only persist last_active at LAST_ACTIVE_UPDATE_INTERVAL granularity
+    if not user.last_active or \
+            now - user.last_active >= timedelta(seconds=config.LAST_ACTIVE_UPDATE_INTERVAL):
+        updates['last_active'] = now
+    
+    # Only write profile fields that actually differ
+    for field, value in (('username', username), ('first_name', first_name), ('last_name', last_name)):
+        if value and getattr(user, field) != value:
+            updates[field] = value
+    
+    return updates
+
+def _get_user_counter_deltas(user, updates):
+    """Counter changes implied by get_user's updates"""
+    deltas = {}
+    if 'last_active' in updates and (not user.last_active or user.last_active < today_start()):
+        deltas[active_day(updates['last_active'].date())] = 1
+    return deltas
+
+async def get_user(user_id, username=None, first_name=None, last_name=None):
     """Get or create user in database"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    
-    if not user:
-        user = User(
-            user_id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
-        )
-        session.add(user)
-        session.commit()
-    else:
-        user.last_active = datetime.utcnow()
-        user.username = username or user.username
-        user.first_name = first_name or user.first_name
-        user.last_name = last_name or user.last_name
-        session.commit()
-    
-    # Check if block duration has expired (skip for admins)
-    if user.is_blocked and user.blocked_until and datetime.utcnow() > user.blocked_until:
-        user.is_blocked = False
-        user.warnings = 0
-        user.blocked_until = None
-        session.commit()
+    now = datetime.utcnow()
     
-    session.close()
+    user = _user_cache.get(user_id)
+    if user is not None:
+        updates = _get_user_updates(user, now, username, first_name, last_name)
+        if updates:
+            async with AsyncSession() as session:
+                await session.execute(update(User).filter_by(user_id=user_id).values(**updates))
+                await bump_counters(session, _get_user_counter_deltas(user, updates))
+                await session.commit()
+            for field, value in updates.items():
+                setattr(user, field, value)
+        return user
+    
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        
+        if not user:
+            # A concurrent first update from the same user may insert the row first
+            result = await session.execute(
+                upsert(User).values(
+                    user_id=user_id,
+                    username=username,
+                    first_name=first_name,
+                    last_name=last_name,
+                    last_active=now
+                ).on_conflict_do_nothing(index_elements=[User.user_id])
+            )
+            if result.rowcount:
+                await bump_counters(session, {'users': 1, active_day(now.date()): 1})
+            await session.commit()
+            user = await session.scalar(select(User).filter_by(user_id=user_id))
+        else:
+            updates = _get_user_updates(user, now, username, first_name, last_name)
+            if updates:
+                await bump_counters(session, _get_user_counter_deltas(user, updates))
+                for field, value in updates.items():
+                    setattr(user, field, value)
+                await session.commit()
+    
+    _user_cache.set(user_id, user)
     return user
 
-def log_user_action(user_id, action):
-    """Log user action to database"""
-    session = Session()
-    user_action = UserAction(user_id=user_id, action=action)
-    session.add(user_action)
-    session.commit()
-    session.close()
+# UserAction and ContentAccessEvent rows waiting for the next bulk insert
+# (see flush_pending_events)
+_pending_actions = []
+_pending_access_events = []
+_flush_lock = asyncio.Lock()
 
-def add_warning(user_id):
+async def log_user_action(user_id, action):
+    """Queue user action; it is written to the database in batches"""
+    _pending_actions.append({
+        'user_id': user_id,
+        'action': action,
+        'timestamp': datetime.utcnow()
+    })
+    if len(_pending_actions) >= config.ACTION_LOG_BATCH_SIZE:
+        await flush_pending_events()
+
+async def log_content_access(user_id, content, delivery, latency_ms):
+    """Queue a structured content delivery event"""
+    chapter = await get_chapter_by_id(content.chapter_id)
+    _pending_access_events.append({
+        'user_id': user_id,
+        'content_id': content.id,
+        'chapter_id': content.chapter_id,
+        'subject_id': chapter.subject_id if chapter else 0,
+        'content_type': content.content_type,
+        'delivery': delivery,
+        'latency_ms': latency_ms,
+        'timestamp': datetime.utcnow()
+    })
+    if len(_pending_access_events) >= config.ACTION_LOG_BATCH_SIZE:
+        await flush_pending_events()
+
+async def flush_pending_events():
+    """Write all queued user actions and access events in bulk inserts"""
+    async with _flush_lock:
+        if not _pending_actions and not _pending_access_events:
+            return 0
+        
+        actions = _pending_actions.copy()
+        access_events = _pending_access_events.copy()
+        _pending_actions.clear()
+        _pending_access_events.clear()
+        
+        async with AsyncSession() as session:
+            try:
+                if actions:
+                    await session.execute(insert(UserAction), actions)
+                if access_events:
+                    await session.execute(insert(ContentAccessEvent), access_events)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                # Keep the rows for the next flush
+                _pending_actions[:0] = actions
+                _pending_access_events[:0] = access_events
+                print(f"Error flushing pending events: {e}")
+                return 0
+        
+        return len(actions) + len(access_events)
+
+async def add_warning(user_id):
     """Add warning to user (skip for admins)"""
     # Skip warning addition for admins
     if user_id in config.ADMIN_IDS:
         return 0
+    
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        if not user:
+            return 0
         
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    if user:
         user.warnings += 1
         if user.warnings >= config.MAX_WARNINGS:
+            if not user.is_blocked:
+                await bump_counters(session, {'blocked_users': 1})
             user.is_blocked = True
             user.blocked_until = datetime.utcnow() + timedelta(seconds=config.BLOCK_DURATION)
-        session.commit()
-        warnings = user.warnings
-    else:
-        warnings = 0
+        await session.commit()
     
-    session.close()
-    return warnings
+    _user_cache.set(user_id, user)
+    return user.warnings
 
-def block_user(user_id):
+async def block_user(user_id):
     """Block a user (cannot block admins)"""
     # Don't block admins
     if user_id in config.ADMIN_IDS:
         return False
     
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    if user:
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        if not user:
+            return False
+        
+        if not user.is_blocked:
+            await bump_counters(session, {'blocked_users': 1})
         user.is_blocked = True
         user.blocked_until = datetime.utcnow() + timedelta(seconds=config.BLOCK_DURATION)
         user.warnings = config.MAX_WARNINGS  # Set to max warnings
-        session.commit()
-        session.close()
-        return True
-    session.close()
-    return False
+        await session.commit()
+    
+    _user_cache.set(user_id, user)
+    return True
 
-def unblock_user(user_id):
+async def unblock_user(user_id):
     """Unblock a user"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    if user:
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        if not user:
+            return False
+        
+        if user.is_blocked:
+            await bump_counters(session, {'blocked_users': -1})
         user.is_blocked = False
         user.warnings = 0
         user.blocked_until = None
-        session.commit()
-        session.close()
-        return True
-    session.close()
-    return False
+        await session.commit()
+    
+    _user_cache.set(user_id, user)
+    return True
+
+async def expire_blocks():
+    """Lift every block whose blocked_until has passed; returns how many"""
+    async with AsyncSession() as session:
+        expired = (await session.scalars(
+            update(User)
+            .filter(User.is_blocked == True, User.blocked_until <= datetime.utcnow())
+            .values(is_blocked=False, warnings=0, blocked_until=None)
+            .returning(User.user_id)
+            .execution_options(synchronize_session=False)
+        )).all()
+        if expired:
+            await bump_counters(session, {'blocked_users': -len(expired)})
+        await session.commit()
+    
+    for user_id in expired:
+        _user_cache.pop(user_id)
+    return len(expired)
+
+async def _iter_file_chunks(file):
+    """Yield the contents of a Telegram File in DOWNLOAD_CHUNK_SIZE pieces"""
+    if urlparse(file.file_path).scheme in ('http', 'https'):
+        timeout = httpx.Timeout(config.DOWNLOAD_TIMEOUT)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            async with client.stream("GET", file.file_path) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(config.DOWNLOAD_CHUNK_SIZE):
+                    yield chunk
+    else:
+        # Local Bot API server: file_path is already a path on this machine
+        async with aiofiles.open(file.file_path, 'rb') as source:
+            while True:
+                chunk = await source.read(config.DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
 
-def save_file(file, content_type, chapter_id, content_number):
-    """Save uploaded file to storage"""
-    # Determine directory based on content type
+async def save_file(file, content_type):
+    """Stream an uploaded file into the content-addressed blob store
+    
+    The download goes to a .part file that is checksummed as it arrives,
+    fsynced and then renamed to its blob path, so a blob never holds a partial
+    file. Bytes that are already stored are not kept twice. Returns
+    (file_path, size, sha256 hex digest), or None on failure.
+    """
     if content_type == "lecture":
-        directory = config.LECTURES_DIR
         ext = "mp4"
-    elif content_type == "note":
-        directory = config.NOTES_DIR
-        ext = "pdf"
-    elif content_type == "dpp":
-        directory = config.DPP_DIR
+    elif content_type in ("note", "dpp"):
         ext = "pdf"
     else:
         return None
     
-    # Create filename
-    filename = f"{chapter_id}_{content_number}_{content_type}.{ext}"
-    file_path = os.path.join(directory, filename)
-    
-    # Save file
-    file.download(file_path)
+    # Same filesystem as the blobs, so the final rename is atomic
+    temp_path = os.path.join(config.BLOBS_DIR, f"upload_{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, 'wb') as out:
+            async for chunk in _iter_file_chunks(file):
+                digest.update(chunk)
+                size += len(chunk)
+                await out.write(chunk)
+            await out.flush()
+            await asyncio.to_thread(os.fsync, out.fileno())
+        
+        sha256 = digest.hexdigest()
+        # Known blobs keep their path, including ones whose file was evicted
+        file_path = await get_blob_path(sha256) or blob_path(sha256, ext)
+        if os.path.exists(file_path):
+            # Already stored
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            await aiofiles.os.replace(temp_path, file_path)
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        print(f"Error saving file: {e}")
+        return None
     
-    return file_path
+    return file_path, size, sha256
 
-def delete_chapter(chapter_id):
+async def delete_chapter(chapter_id):
     """Delete a chapter and all its associated content and files"""
-    session = Session()
-    try:
-        chapter = session.query(Chapter).get(chapter_id)
-        if not chapter:
+    async with AsyncSession() as session:
+        try:
+            chapter = await session.scalar(
+                select(Chapter).options(selectinload(Chapter.contents)).filter_by(id=chapter_id)
+            )
+            if not chapter:
+                return False
+            
+            # Delete associated files (from before blob storage)
+            remove_files([content.file_path for content in chapter.contents if not content.file_sha256])
+            
+            # Delete chapter (contents will be deleted due to cascade)
+            deltas = content_deltas(chapter.subject_id, chapter.contents, sign=-1)
+            deltas.update({'chapters': -1, subject_chapters(chapter.subject_id): -1})
+            await bump_counters(session, deltas)
+            orphaned = await release_blobs(session, [content.file_sha256 for content in chapter.contents])
+            await remove_documents(session, 'chapter', [chapter.id])
+            await remove_documents(session, 'content', [content.id for content in chapter.contents])
+            await session.delete(chapter)
+            await session.commit()
+            remove_files(orphaned)
+            invalidate_catalog()
+            return True
+        except Exception as e:
+            await session.rollback()
+            print(f"Error deleting chapter: {e}")
             return False
-        
-        # Get all contents for this chapter
-        contents = session.query(Content).filter_by(chapter_id=chapter_id).all()
-        
-        # Delete associated files
-        for content in contents:
-            if os.path.exists(content.file_path):
-                try:
-                    os.remove(content.file_path)
-                except:
-                    pass  # Ignore file deletion errors
-        
-        # Delete chapter (contents will be deleted due to cascade)
-        session.delete(chapter)
-        session.commit()
-        return True
-    except Exception as e:
-        session.rollback()
-        print(f"Error deleting chapter: {e}")
-        return False
-    finally:
-        session.close()
 
-def delete_content(content_id):
+async def delete_content(content_id):
     """Delete specific content and its file"""
-    session = Session()
-    try:
-        content = session.query(Content).get(content_id)
-        if not content:
+    async with AsyncSession() as session:
+        try:
+            content = await session.get(Content, content_id)
+            if not content:
+                return False
+            
+            # Delete file (from before blob storage)
+            if not content.file_sha256:
+                remove_files([content.file_path])
+            
+            # Delete content from database
+            chapter = await session.get(Chapter, content.chapter_id)
+            await bump_counters(session, content_deltas(chapter.subject_id, [content], sign=-1))
+            orphaned = await release_blobs(session, [content.file_sha256])
+            await remove_documents(session, 'content', [content.id])
+            await session.delete(content)
+            await session.commit()
+            remove_files(orphaned)
+            invalidate_catalog()
+            return True
+        except Exception as e:
+            await session.rollback()
+            print(f"Error deleting content: {e}")
             return False
-        
-        # Delete file
-        if os.path.exists(content.file_path):
-            try:
-                os.remove(content.file_path)
-            except:
-                pass  # Ignore file deletion errors
-        
-        # Delete content from database
-        session.delete(content)
-        session.commit()
-        return True
-    except Exception as e:
-        session.rollback()
-        print(f"Error deleting content: {e}")
-        return False
-    finally:
-        session.close()
 
-def get_user_stats(user_id):
+async def get_user_stats(user_id):
     """Get statistics for a user"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    
-    if not user:
-        session.close()
-        return None
+    await flush_pending_events()
     
-    # Count user actions
-    actions_count = session.query(UserAction).filter_by(user_id=user_id).count()
-    
-    # Get last 10 actions
-    recent_actions = session.query(UserAction).filter_by(user_id=user_id)\
-        .order_by(UserAction.timestamp.desc())\
-        .limit(10)\
-        .all()
-    
-    session.close()
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        
+        if not user:
+            return None
+        
+        # Count user actions
+        actions_count = await count_user_actions(session, user_id)
+        
+        # Get last 10 actions
+        recent_actions = (await session.scalars(
+            select(UserAction).filter_by(user_id=user_id)
+            .order_by(UserAction.timestamp.desc())
+            .limit(10)
+        )).all()
     
     return {
         'user': user,
@@ -202,89 +383,96 @@ def get_user_stats(user_id):
         'recent_actions': recent_actions
     }
 
-def get_bot_stats():
+# Dashboard stats are expensive and fine to show slightly stale
+_stats_cache = TTLCache(maxsize=8, ttl=config.STATS_CACHE_TTL)
+
+async def get_bot_stats(use_cache=True):
     """Get overall bot statistics"""
-    session = Session()
-    
-    total_users = session.query(User).count()
-    active_users = session.query(User).filter_by(is_blocked=False).count()
-    blocked_users = session.query(User).filter_by(is_blocked=True).count()
-    total_chapters = session.query(Chapter).count()
-    total_contents = session.query(Content).count()
+    if use_cache:
+        cached = _stats_cache.get('bot_stats')
+        if cached is not None:
+            return cached
     
-    # Get today's active users
-    today = datetime.utcnow().date()
-    today_users = session.query(User)\
-        .filter(User.last_active >= datetime.combine(today, datetime.min.time()))\
-        .count()
+    counters = await get_counters()
+    total_users = counters.get('users', 0)
+    blocked_users = counters.get('blocked_users', 0)
     
     # Get subject stats
     subject_stats = {}
-    subjects = session.query(Subject).all()
-    for subject in subjects:
-        chapter_count = session.query(Chapter).filter_by(subject_id=subject.id).count()
-        content_count = session.query(Content).join(Chapter).filter(Chapter.subject_id == subject.id).count()
+    for subject in (await get_catalog())['subjects_by_id'].values():
         subject_stats[subject.name] = {
-            'chapters': chapter_count,
-            'contents': content_count
+            'chapters': counters.get(subject_chapters(subject.id), 0),
+            'contents': counters.get(subject_contents(subject.id), 0)
         }
     
-    session.close()
-    
-    return {
+    stats = {
         'total_users': total_users,
-        'active_users': active_users,
+        'active_users': total_users - blocked_users,
         'blocked_users': blocked_users,
-        'today_active': today_users,
-        'total_chapters': total_chapters,
-        'total_contents': total_contents,
+        'today_active': counters.get(active_day(datetime.utcnow().date()), 0),
+        'total_chapters': counters.get('chapters', 0),
+        'total_contents': counters.get('contents', 0),
         'subject_stats': subject_stats
     }
+    _stats_cache.set('bot_stats', stats)
+    return stats
 
-def cleanup_old_files():
+async def cleanup_old_files():
     """Clean up orphaned files (files not referenced in database)"""
-    session = Session()
-    
     # Get all file paths from database
-    db_files = set()
-    contents = session.query(Content.file_path).all()
-    for content in contents:
-        if content.file_path:
-            db_files.add(content.file_path)
-    
-    session.close()
+    async with AsyncSession() as session:
+        db_files = set(await session.scalars(
+            select(Content.file_path).filter(Content.file_path.isnot(None))
+        ))
+        db_files.update(await session.scalars(select(Blob.file_path)))
     
     # Check all storage directories
-    deleted_count = 0
+    orphaned = []
     for directory in [config.LECTURES_DIR, config.NOTES_DIR, config.DPP_DIR]:
         if os.path.exists(directory):
             for filename in os.listdir(directory):
                 file_path = os.path.join(directory, filename)
                 if file_path not in db_files:
-                    try:
-                        os.remove(file_path)
-                        deleted_count += 1
-                        print(f"Deleted orphaned file: {file_path}")
-                    except Exception as e:
-                        print(f"Error deleting file {file_path}: {e}")
+                    orphaned.append(file_path)
+    
+    # Blobs get their row only after the file is saved, and downloads in
+    # progress are .part files; leave recently written ones alone
+    cutoff = time.time() - config.ORPHAN_FILE_MIN_AGE
+    for directory, _, filenames in os.walk(config.BLOBS_DIR):
+        for filename in filenames:
+            file_path = os.path.join(directory, filename)
+            if file_path not in db_files and os.path.getmtime(file_path) < cutoff:
+                orphaned.append(file_path)
+    
+    deleted_count = 0
+    for file_path in orphaned:
+        try:
+            os.remove(file_path)
+            deleted_count += 1
+            print(f"Deleted orphaned file: {file_path}")
+        except Exception as e:
+            print(f"Error deleting file {file_path}: {e}")
     
     return deleted_count
 
-def export_user_data(user_id):
+async def export_user_data(user_id):
     """Export all data for a user (for GDPR compliance)"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
+    await flush_pending_events()
     
-    if not user:
-        session.close()
-        return None
-    
-    # Get all user actions
-    actions = session.query(UserAction).filter_by(user_id=user_id)\
-        .order_by(UserAction.timestamp)\
-        .all()
-    
-    session.close()
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        
+        if not user:
+            return None
+        
+        # Get all user actions still within the retention window
+        actions = (await session.scalars(
+            select(UserAction).filter_by(user_id=user_id)
+            .order_by(UserAction.timestamp)
+        )).all()
+        
+        # Daily totals cover actions older than the retention window too
+        daily_actions = await get_daily_actions(session, user_id)
     
     # Format data
     user_data = {
@@ -305,6 +493,14 @@ def export_user_data(user_id):
                 'timestamp': action.timestamp.isoformat()
             }
             for action in actions
+        ],
+        'daily_actions': [
+            {
+                'day': daily.day.isoformat(),
+                'action': daily.action,
+                'count': daily.count
+            }
+            for daily in daily_actions
         ]
     }
     
@@ -333,17 +529,18 @@ def backup_database():
         print("PostgreSQL backup requires pg_dump utility")
         return None
 
-def reset_user_warnings(user_id):
+async def reset_user_warnings(user_id):
     """Reset warnings for a user"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    if user:
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        if not user:
+            return False
+        
         user.warnings = 0
-        session.commit()
-        session.close()
-        return True
-    session.close()
-    return False
+        await session.commit()
+    
+    _user_cache.set(user_id, user)
+    return True
 
 def is_admin(user_id):
     """Check if user is admin"""
@@ -375,151 +572,355 @@ def remove_admin(user_id):
         return True
     return False
 
-def get_chapter_by_name(subject_id, chapter_name):
+async def get_chapter_by_name(subject_id, chapter_name):
     """Get chapter by name and subject"""
-    session = Session()
-    chapter = session.query(Chapter).filter_by(
-        subject_id=subject_id,
-        name=chapter_name
-    ).first()
-    session.close()
+    catalog = await get_catalog()
+    for chapter in catalog['chapters_by_subject'].get(subject_id, []):
+        if chapter.name == chapter_name:
+            return chapter
+    return None
+
+async def get_chapter_by_id(chapter_id):
+    """Get chapter by its ID, with its subject loaded"""
+    catalog = await get_catalog()
+    return catalog['chapters_by_id'].get(chapter_id)
+
+async def add_chapter(subject_id, chapter_name):
+    """Add a new chapter to a subject"""
+    async with AsyncSession() as session:
+        chapter = Chapter(subject_id=subject_id, name=chapter_name)
+        session.add(chapter)
+        await session.flush()
+        await bump_counters(session, {'chapters': 1, subject_chapters(subject_id): 1})
+        index_chapter(session, chapter, await session.get(Subject, subject_id))
+        await session.commit()
+    
+    invalidate_catalog()
     return chapter
 
-def get_content_by_details(chapter_id, content_type, content_number):
+async def get_content_by_details(chapter_id, content_type, content_number):
     """Get content by chapter, type, and number"""
-    session = Session()
-    content = session.query(Content).filter_by(
-        chapter_id=chapter_id,
-        content_type=content_type,
-        content_number=content_number
-    ).first()
-    session.close()
+    catalog = await get_catalog()
+    return catalog['contents'].get((chapter_id, content_type, content_number))
+
+async def get_content_by_id(content_id):
+    """Get content by its ID"""
+    catalog = await get_catalog()
+    return catalog['contents_by_id'].get(content_id)
+
+async def add_content(chapter_id, content_type, content_number, file_path=None, file_size=None,
+                      file_sha256=None, file_id=None, file_unique_id=None):
+    """Add a new content row for a local file and/or a Telegram file_id
+    
+    Returns None if the chapter already has content with this type and number.
+    """
+    async with AsyncSession() as session:
+        if file_unique_id and not file_sha256:
+            # The same Telegram file may already have a local copy
+            twin = await session.scalar(
+                select(Content)
+                .filter(Content.file_unique_id == file_unique_id, Content.file_sha256.isnot(None))
+                .limit(1)
+            )
+            if twin:
+                file_path, file_size, file_sha256 = twin.file_path, twin.file_size, twin.file_sha256
+        
+        content = Content(
+            chapter_id=chapter_id,
+            content_type=content_type,
+            content_number=content_number,
+            file_path=file_path or "",
+            file_size=file_size,
+            file_sha256=file_sha256,
+            file_id=file_id,
+            file_unique_id=file_unique_id
+        )
+        try:
+            if file_sha256:
+                # Identical bytes are uploaded to Telegram only once
+                content.file_id = file_id or await get_shared_file_id(session, file_sha256)
+                await acquire_blob(session, file_sha256, file_path, file_size)
+            session.add(content)
+            await session.flush()
+        except IntegrityError:
+            # The slot was filled since the number was checked
+            await session.rollback()
+            print(f"Error adding content: chapter {chapter_id} already has {content_type} #{content_number}")
+            if file_sha256 and not await get_blob_path(file_sha256):
+                remove_files([file_path])  # Saved for this content only
+            return None
+        chapter = await session.get(Chapter, chapter_id)
+        await bump_counters(session, content_deltas(chapter.subject_id, [content]))
+        index_content(session, content, chapter, await session.get(Subject, chapter.subject_id))
+        await session.commit()
+    
+    invalidate_catalog()
     return content
 
-def get_all_chapters(subject_id=None):
+async def set_content_file(content_id, file_path, file_size, file_sha256):
+    """Attach a local copy (a blob) to an existing content"""
+    async with AsyncSession() as session:
+        content = await session.get(Content, content_id)
+        if not content:
+            return False
+        
+        await acquire_blob(session, file_sha256, file_path, file_size)
+        orphaned = await release_blobs(session, [content.file_sha256])
+        content.file_path = file_path
+        content.file_size = file_size
+        content.file_sha256 = file_sha256
+        await session.commit()
+    
+    remove_files(orphaned)
+    update_catalog_content(
+        content_id, file_path=file_path, file_size=file_size, file_sha256=file_sha256
+    )
+    return True
+
+async def get_all_chapters(subject_id=None):
     """Get all chapters, optionally filtered by subject"""
-    session = Session()
+    catalog = await get_catalog()
     if subject_id:
-        chapters = session.query(Chapter).filter_by(subject_id=subject_id).all()
-    else:
-        chapters = session.query(Chapter).all()
-    session.close()
-    return chapters
+        return list(catalog['chapters_by_subject'].get(subject_id, []))
+    return list(catalog['chapters_by_id'].values())
 
-def get_all_contents(chapter_id=None, content_type=None):
+async def get_all_contents(chapter_id=None, content_type=None):
     """Get all contents, optionally filtered by chapter and/or type"""
-    session = Session()
-    query = session.query(Content)
+    catalog = await get_catalog()
+    contents = catalog['contents_by_id'].values()
     
     if chapter_id:
-        query = query.filter_by(chapter_id=chapter_id)
+        contents = [c for c in contents if c.chapter_id == chapter_id]
     
     if content_type:
-        query = query.filter_by(content_type=content_type)
+        contents = [c for c in contents if c.content_type == content_type]
     
-    contents = query.all()
-    session.close()
-    return contents
+    return list(contents)
 
-def search_chapters(search_term):
+async def search_catalog(search_term, limit=None):
+    """Full-text search over chapters and contents
+    
+    Returns ranked (kind, item, chapter) tuples, where kind is 'chapter' or
+    'content' and chapter (with its subject) is the item's chapter.
+    """
+    catalog = await get_catalog()
+    results = []
+    for kind, ref_id in await search_documents(search_term, limit):
+        if kind == 'chapter':
+            chapter = catalog['chapters_by_id'].get(ref_id)
+            item = chapter
+        else:
+            item = catalog['contents_by_id'].get(ref_id)
+            chapter = catalog['chapters_by_id'].get(item.chapter_id) if item else None
+        if item is not None and chapter is not None:
+            results.append((kind, item, chapter))
+    return results
+
+async def search_chapters(search_term):
     """Search chapters by name"""
-    session = Session()
-    chapters = session.query(Chapter).filter(
-        Chapter.name.ilike(f"%{search_term}%")
-    ).all()
-    session.close()
-    return chapters
-
-def get_subject_by_code(subject_code):
+    return [item for kind, item, _ in await search_catalog(search_term) if kind == 'chapter']
+
+async def get_subject_by_code(subject_code):
     """Get subject by its code"""
-    session = Session()
-    subject = session.query(Subject).filter_by(code=subject_code).first()
-    session.close()
-    return subject
+    catalog = await get_catalog()
+    return catalog['subjects_by_code'].get(subject_code)
 
-def get_subject_by_id(subject_id):
+async def get_subject_by_id(subject_id):
     """Get subject by its ID"""
-    session = Session()
-    subject = session.query(Subject).get(subject_id)
-    session.close()
-    return subject
-
-def update_file_id(content_id, file_id):
-    """Update Telegram file_id for content"""
-    session = Session()
-    content = session.query(Content).get(content_id)
-    if content:
-        content.file_id = file_id
-        session.commit()
-        session.close()
-        return True
-    session.close()
-    return False
+    catalog = await get_catalog()
+    return catalog['subjects_by_id'].get(subject_id)
 
-def get_user_by_id(user_id):
+async def update_file_id(content_id, file_id):
+    """Update Telegram file_id for content and every content sharing its blob"""
+    async with AsyncSession() as session:
+        content = await session.get(Content, content_id)
+        if not content:
+            return False
+        
+        if content.file_sha256:
+            content_ids = (await session.scalars(
+                update(Content)
+                .filter_by(file_sha256=content.file_sha256)
+                .values(file_id=file_id)
+                .returning(Content.id)
+                .execution_options(synchronize_session=False)
+            )).all()
+        else:
+            content.file_id = file_id
+            content_ids = [content_id]
+        await session.commit()
+    
+    for content_id in content_ids:
+        set_content_file_id(content_id, file_id)
+    return True
+
+async def get_user_by_id(user_id):
     """Get user by Telegram user ID"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    session.close()
-    return user
+    async with AsyncSession() as session:
+        return await session.scalar(select(User).filter_by(user_id=user_id))
 
-def update_user_info(user_id, username=None, first_name=None, last_name=None):
+async def update_user_info(user_id, username=None, first_name=None, last_name=None):
     """Update user information"""
-    session = Session()
-    user = session.query(User).filter_by(user_id=user_id).first()
-    if user:
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(user_id=user_id))
+        if not user:
+            return False
+        
         if username is not None:
             user.username = username
         if first_name is not None:
             user.first_name = first_name
         if last_name is not None:
             user.last_name = last_name
-        session.commit()
-        session.close()
-        return True
-    session.close()
-    return False
+        await session.commit()
+    
+    _user_cache.set(user_id, user)
+    return True
 
-def get_recent_users(limit=20):
+async def get_recent_users(limit=20):
     """Get recently active users"""
-    session = Session()
-    users = session.query(User).order_by(User.last_active.desc()).limit(limit).all()
-    session.close()
-    return users
+    async with AsyncSession() as session:
+        return (await session.scalars(
+            select(User).order_by(User.last_active.desc()).limit(limit)
+        )).all()
+
+def _user_search_clause(search):
+    """Match a user ID, or a username / first name prefix (case-insensitive)"""
+    term = search.strip().lstrip('@').lower()
+    # Range comparison instead of LIKE so the lower() indexes are usable
+    clauses = [
+        and_(func.lower(User.username) >= term, func.lower(User.username) < term + '\uffff'),
+        and_(func.lower(User.first_name) >= term, func.lower(User.first_name) < term + '\uffff'),
+    ]
+    if term.isdigit():
+        clauses.append(User.user_id == int(term))
+    return or_(*clauses)
+
+async def get_users_page(user_filter="all", search=None, before_id=None, after_id=None, limit=None):
+    """Get one page of users, newest first, using keyset pagination on User.id
+    
+    Pass before_id to get the next (older) page, after_id for the previous one.
+    Returns (users, prev_cursor, next_cursor); a cursor is None when there is no
+    page in that direction.
+    """
+    limit = limit or config.USERS_PAGE_SIZE
+    query = select(User)
+    
+    if user_filter == "blocked":
+        query = query.filter(User.is_blocked == True)
+    elif user_filter == "search":
+        query = query.filter(_user_search_clause(search or ""))
+    
+    if after_id is not None:
+        query = query.filter(User.id > after_id).order_by(User.id.asc())
+    else:
+        if before_id is not None:
+            query = query.filter(User.id < before_id)
+        query = query.order_by(User.id.desc())
+    
+    async with AsyncSession() as session:
+        users = (await session.scalars(query.limit(limit + 1))).all()
+    
+    has_more = len(users) > limit
+    users = list(users[:limit])
+    if not users:
+        return [], None, None
+    
+    if after_id is not None:
+        users.reverse()
+        return users, users[0].id if has_more else None, users[-1].id
+    return users, users[0].id if before_id is not None else None, users[-1].id if has_more else None
 
-def get_blocked_users():
+async def get_blocked_users():
     """Get all blocked users"""
-    session = Session()
-    users = session.query(User).filter_by(is_blocked=True).all()
-    session.close()
-    return users
+    async with AsyncSession() as session:
+        return (await session.scalars(select(User).filter_by(is_blocked=True))).all()
+
+# Bulk moderation actions: the rows each one still has to touch, and the new
+# values. Updated rows drop out of the filter, so batches converge.
+BULK_ACTIONS = {
+    'clear': "Clear warnings",
+    'block': "Block",
+    'unblock': "Unblock",
+}
+
+def _bulk_action_values(action, now):
+    """(filter, values, blocked_users delta per row) for a bulk action"""
+    if action == 'clear':
+        return User.warnings != 0, {'warnings': 0}, 0
+    if action == 'block':
+        return (
+            and_(User.is_blocked == False, User.user_id.notin_(config.ADMIN_IDS)),
+            {
+                'is_blocked': True,
+                'warnings': config.MAX_WARNINGS,
+                'blocked_until': now + timedelta(seconds=config.BLOCK_DURATION)
+            },
+            1
+        )
+    if action == 'unblock':
+        return User.is_blocked == True, {'is_blocked': False, 'warnings': 0, 'blocked_until': None}, -1
+    raise ValueError(f"Unknown bulk action: {action}")
 
-def clear_all_warnings():
+async def bulk_moderate(action, inactive_days=None, min_warnings=None, progress=None):
+    """Apply a moderation action to every matching user in bounded batches
+    
+    Optionally restrict to users inactive for inactive_days or with at least
+    min_warnings warnings. progress, if given, is awaited with the running
+    total after each batch. Returns the number of users updated.
+    """
+    now = datetime.utcnow()
+    condition, values, blocked_delta = _bulk_action_values(action, now)
+    if inactive_days is not None:
+        condition = and_(condition, User.last_active < now - timedelta(days=inactive_days))
+    if min_warnings is not None:
+        condition = and_(condition, User.warnings >= min_warnings)
+    
+    total = 0
+    while True:
+        async with AsyncSession() as session:
+            batch = select(User.id).filter(condition).order_by(User.id).limit(config.BULK_MODERATION_BATCH_SIZE)
+            user_ids = (await session.scalars(
+                update(User)
+                .filter(User.id.in_(batch))
+                .values(**values)
+                .returning(User.user_id)
+                .execution_options(synchronize_session=False)
+            )).all()
+            if user_ids and blocked_delta:
+                await bump_counters(session, {'blocked_users': blocked_delta * len(user_ids)})
+            await session.commit()
+        
+        for user_id in user_ids:
+            _user_cache.pop(user_id)
+        total += len(user_ids)
+        if progress:
+            await progress(total)
+        if len(user_ids) < config.BULK_MODERATION_BATCH_SIZE:
+            break
+    
+    return total
+
+async def clear_all_warnings():
     """Clear warnings for all users"""
-    session = Session()
-    users = session.query(User).all()
-    for user in users:
-        user.warnings = 0
-    session.commit()
-    session.close()
+    await bulk_moderate('clear')
     return True
 
 def get_storage_stats():
     """Get storage statistics"""
     total_size = 0
-    file_counts = {'lectures': 0, 'notes': 0, 'dpp': 0}
+    file_counts = {'lectures': 0, 'notes': 0, 'dpp': 0, 'blobs': 0}
     
     for dir_name, dir_path in [
         ('lectures', config.LECTURES_DIR),
         ('notes', config.NOTES_DIR),
-        ('dpp', config.DPP_DIR)
+        ('dpp', config.DPP_DIR),
+        ('blobs', config.BLOBS_DIR)
     ]:
-        if os.path.exists(dir_path):
-            for filename in os.listdir(dir_path):
-                file_path = os.path.join(dir_path, filename)
-                if os.path.isfile(file_path):
-                    total_size += os.path.getsize(file_path)
-                    file_counts[dir_name] += 1
+        for root, dirs, files in os.walk(dir_path):
+            for filename in files:
+                total_size += os.path.getsize(os.path.join(root, filename))
+                file_counts[dir_name] += 1
     
     return {
         'total_size_mb': round(total_size / (1024 * 1024), 2),
@@ -527,9 +928,12 @@ def get_storage_stats():
         'total_files': sum(file_counts.values())
     }
 
-def get_content_stats():
+async def get_content_stats(use_cache=True):
     """Get content statistics by type"""
-    session = Session()
+    if use_cache:
+        cached = _stats_cache.get('content_stats')
+        if cached is not None:
+            return cached
     
     stats = {
         'lectures': 0,
@@ -537,27 +941,23 @@ def get_content_stats():
         'dpp': 0
     }
     
+    counters = await get_counters()
+    
     # Count by content type
     for content_type in ['lecture', 'note', 'dpp']:
-        count = session.query(Content).filter_by(content_type=content_type).count()
-        stats[content_type + 's'] = count
+        stats[content_type + 's'] = counters.get(type_contents(content_type), 0)
     
     # Count by subject
     subject_stats = {}
-    subjects = session.query(Subject).all()
-    for subject in subjects:
-        content_count = session.query(Content)\
-            .join(Chapter)\
-            .filter(Chapter.subject_id == subject.id)\
-            .count()
-        subject_stats[subject.name] = content_count
-    
-    session.close()
+    for subject in (await get_catalog())['subjects_by_id'].values():
+        subject_stats[subject.name] = counters.get(subject_contents(subject.id), 0)
     
-    return {
+    content_stats = {
         'by_type': stats,
         'by_subject': subject_stats
     }
+    _stats_cache.set('content_stats', content_stats)
+    return content_stats
 
 def validate_file_extension(filename, content_type):
     """Validate file extension based on content type"""
@@ -576,6 +976,12 @@ def get_file_extension(content_type):
     else:  # note or dpp
         return ".pdf"
 
+def get_content_caption(content):
+    """Caption used when sending content"""
+    if content.content_type == "lecture":
+        return f"🎥 Lecture #{content.content_number}"
+    return f"📄 {config.CONTENT_TYPES[content.content_type]} #{content.content_number}"
+
 def format_file_size(size_in_bytes):
     """Format file size in human readable format"""
     for unit in ['B', 'KB', 'MB', 'GB']:
@@ -611,7 +1017,7 @@ def create_backup():
                     zipf.write(db_path, 'database.db')
             
             # Add important directories
-            for dir_name in ['lectures', 'notes', 'dpp']:
+            for dir_name in ['lectures', 'notes', 'dpp', 'blobs']:
                 dir_path = os.path.join(config.FILES_DIR, dir_name)
                 if os.path.exists(dir_path):
                     for root, dirs, files in os.walk(dir_path):
@@ -672,36 +1078,33 @@ def sanitize_filename(filename):
         filename = filename[:200]
     return filename
 
-def get_next_content_number(chapter_id, content_type):
+async def get_next_content_number(chapter_id, content_type):
     """Get the next available content number for a chapter and type"""
-    session = Session()
-    max_number = session.query(Content.content_number)\
-        .filter_by(chapter_id=chapter_id, content_type=content_type)\
-        .order_by(Content.content_number.desc())\
-        .first()
-    session.close()
+    async with AsyncSession() as session:
+        max_number = await session.scalar(
+            select(func.max(Content.content_number))
+            .filter_by(chapter_id=chapter_id, content_type=content_type)
+        )
     
     if max_number:
-        return max_number[0] + 1
+        return max_number + 1
     else:
         return 1
 
-def get_chapter_content_summary(chapter_id):
+async def get_chapter_content_summary(chapter_id):
     """Get summary of content in a chapter"""
-    session = Session()
-    
-    # Get content counts by type
-    content_counts = {}
-    for content_type in ['lecture', 'note', 'dpp']:
-        count = session.query(Content)\
-            .filter_by(chapter_id=chapter_id, content_type=content_type)\
-            .count()
-        content_counts[content_type] = count
-    
-    # Get chapter info
-    chapter = session.query(Chapter).get(chapter_id)
-    
-    session.close()
+    async with AsyncSession() as session:
+        # Get content counts by type
+        content_counts = {}
+        for content_type in ['lecture', 'note', 'dpp']:
+            count = await session.scalar(
+                select(func.count(Content.id))
+                .filter_by(chapter_id=chapter_id, content_type=content_type)
+            )
+            content_counts[content_type] = count
+        
+        # Get chapter info
+        chapter = await session.get(Chapter, chapter_id)
     
     return {
         'chapter': chapter,
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+from telegram.error import RetryAfter, TelegramError
+import config
+from utils import get_all_contents, get_content_by_id, update_file_id
+
+logger = logging.getLogger(__name__)
+
+# Content files are uploaded once to config.STORAGE_CHAT_ID so that a Telegram
+# file_id exists before any student asks for them; every delivery is then a
+# cached send. Without a storage chat the first delivery still uploads.
+
+# In-flight uploads by content ID. Concurrent requests for content without a
+# file_id wait for the one upload instead of each sending the whole file.
+_uploads = {}
+
+async def upload_content(bot, chat_id, content, caption, **kwargs):
+    """Upload a content file to a chat and record its file_id; returns the file_id"""
+    with open(content.file_path, 'rb') as file:
+        if content.content_type == "lecture":
+            message = await bot.send_video(
+                chat_id=chat_id, video=file, caption=caption,
+                write_timeout=config.UPLOAD_TIMEOUT, **kwargs
+            )
+            file_id = message.video.file_id
+        else:
+            message = await bot.send_document(
+                chat_id=chat_id, document=file, caption=caption,
+                write_timeout=config.UPLOAD_TIMEOUT, **kwargs
+            )
+            file_id = message.document.file_id
+    
+    await update_file_id(content.id, file_id)
+    return file_id
+
+async def upload_once(content, upload):
+    """Run upload() for content unless an upload is already in flight
+    
+    Returns (file_id, uploaded), where uploaded is False if this call only
+    waited for someone else's upload. Failures are raised to every waiter.
+    """
+    task = _uploads.get(content.id)
+    if task is not None:
+        return await asyncio.shield(task), False
+    
+    # A task, so the upload finishes for the waiters even if this caller is cancelled
+    task = asyncio.ensure_future(upload())
+    _uploads[content.id] = task
+    task.add_done_callback(lambda _: _uploads.pop(content.id, None))
+    return await asyncio.shield(task), True
+
+async def warm_up_content(bot, content_id):
+    """Make sure a content item has a file_id; returns True if one was uploaded"""
+    if not config.STORAGE_CHAT_ID:
+        return False
+    
+    content = await get_content_by_id(content_id)
+    if not content or content.file_id or not os.path.exists(content.file_path):
+        return False
+    
+    try:
+        _, uploaded = await upload_once(content, lambda: upload_content(
+            bot, config.STORAGE_CHAT_ID, content, f"content:{content.id}", disable_notification=True
+        ))
+    except RetryAfter:
+        raise
+    except TelegramError as e:
+        logger.warning(f"Warm-up upload of content {content_id} failed: {e}")
+        return False
+    return uploaded
+
+async def warm_up_missing(bot, limit=None):
+    """Upload up to limit content items that have no file_id yet; returns how many"""
+    if not config.STORAGE_CHAT_ID:
+        return 0
+    
+    pending = [
+        content.id for content in await get_all_contents()
+        if not content.file_id and os.path.exists(content.file_path)
+    ]
+    uploaded = 0
+    for content_id in pending[:limit or config.WARMUP_BATCH_SIZE]:
+        try:
+            if await warm_up_content(bot, content_id):
+                uploaded += 1
+        except RetryAfter as e:
+            # Rate limited; the next run picks up where this one stopped
+            logger.warning(f"Warm-up rate limited for {e.retry_after}s")
+            break
+        await asyncio.sleep(config.WARMUP_DELAY)
+    
+    return uploaded